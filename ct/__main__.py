@@ -1,10 +1,170 @@
-# from ct.scramble import CubeScrambler, CubeMove
-from ct.gui import run_gui
+from argparse import ArgumentParser
+from datetime import date
+import sys
 
+from ct.puzzles import puzzles
 
-def main():
-    run_gui()
+
+# Each command imports what it needs as it runs, so the headless ones start
+# without Qt, matplotlib or pandas
+
+
+def discipline(args):
+    from ct import db
+    from ct.discipline import Discipline
+    if args.database:
+        db.connect(args.database)
+    return Discipline(args.puzzle, args.blind, args.one_handed, args.feet)
+
+
+# Writes fail on the writer thread, where only the timer window reports
+# them, so the commands that write collect the failures and stop at the first
+failures = []
+
+
+def collect_failures():
+    from ct import persist
+    persist.failed.register(lambda error, operations: failures.append(error))
+
+
+def check_written():
+    from ct import db
+    db.writer.wait()
+    if failures:
+        # The driver's error, without the statement and its parameters
+        error = getattr(failures[0], 'orig', failures[0])
+        sys.exit(f'ct: could not write to the database: {error}')
+
+
+def run_gui(args):
+    from ct.gui import run_gui
+    return run_gui()
+
+
+def run_stats(args):
+    from ct.util import format_time
+    target = discipline(args)
+
+    print(f'{target.name}')
+    print(f'{"":>14} {"BEST":>10} {"WHEN":>12} {"LAST":>10}')
+    records = zip(target.records(backend=args.backend), target.current(backend=args.backend))
+    for (name, when, best), (_, _, last) in records:
+        when = when.strftime('%Y-%m-%d') if when else '--'
+        print(f'{name:>14} {format_time(best):>10} {when:>12} {format_time(last):>10}')
+
+    summary = target.distribution(args.since, args.until)
+    print()
+    print(f'{"Solves":>14} {summary.count + summary.dnfs:>10}')
+    print(f'{"DNFs":>14} {summary.dnfs:>10}')
+    for name, value in [
+        ('Mean', summary.mean),
+        ('Std. dev.', summary.std),
+        ('10th pct.', summary.quantile(0.1)),
+        ('Median', summary.median),
+        ('90th pct.', summary.quantile(0.9)),
+    ]:
+        print(f'{name:>14} {format_time(value):>10}')
+    for limit in args.sub:
+        print(f'{f"Sub-{limit:g}":>14} {summary.below(limit * 1000):>10}')
+
+
+def run_export(args):
+    from ct.transfer import export
+    target = discipline(args)
+    format = args.format
+    if format is None:
+        format = next((f for f in ('parquet', 'arrow') if args.file.endswith(f'.{f}')), 'csv')
+    try:
+        export(target, args.file, format, args.since, args.until, not args.no_stats)
+    except ImportError as error:
+        sys.exit(f'ct: {error}')
+
+
+def run_import(args):
+    from ct.transfer import import_file
+    collect_failures()
+    target = discipline(args)
+    total, skipped = import_file(target, args.file)
+    check_written()
+    print(f'Imported {total} solves')
+    for kind, count in skipped.items():
+        print(f'Skipped {count} solves of csTimer type {kind}, which has no discipline here')
+
+
+def run_reindex(args):
+    collect_failures()
+    if not args.all:
+        disciplines = [discipline(args)]
+    else:
+        from ct import db
+        from ct.discipline import Discipline
+        if args.database:
+            db.connect(args.database)
+        disciplines = [
+            Discipline(puzzle, *map(bool, flags)) for puzzle, *flags in db.engine.execute(
+                'SELECT DISTINCT puzzle, blind, one_handed, feet FROM solves'
+            )
+        ]
+    for target in disciplines:
+        target.reindex()
+        check_written()
+        print(f'Reindexed {target.name}')
+
+
+def run_bench(args):
+    from ct.bench import main
+    return main(args.rest)
+
+
+def main(args=None):
+    parser = ArgumentParser(prog='ct', description='Cube timer. Without a command, starts the timer.')
+    parser.set_defaults(run=run_gui)
+    commands = parser.add_subparsers(metavar='command')
+
+    # Options to pick a discipline and a database
+    common = ArgumentParser(add_help=False)
+    common.add_argument('--puzzle', '-p', choices=puzzles, default='3')
+    common.add_argument('--blind', action='store_true')
+    common.add_argument('--one-handed', action='store_true')
+    common.add_argument('--feet', action='store_true')
+    common.add_argument('--database', help='database file, instead of the default one')
+
+    command = commands.add_parser('gui', help='start the timer')
+    command.set_defaults(run=run_gui)
+
+    command = commands.add_parser('stats', parents=[common], help='show records and the distribution of times')
+    command.add_argument('--since', type=date.fromisoformat, help='first day of the distribution')
+    command.add_argument('--until', type=date.fromisoformat, help='day after the distribution')
+    command.add_argument('--sub', type=float, nargs='+', default=[], metavar='SECONDS', help='count solves faster than these')
+    command.add_argument('--backend', choices=['numpy', 'sql'], default='numpy', help='where records are computed')
+    command.set_defaults(run=run_stats)
+
+    command = commands.add_parser('export', parents=[common], help='write solves and their stats as CSV, Parquet or Arrow')
+    command.add_argument('file', nargs='?', default='-')
+    command.add_argument('--format', choices=['csv', 'parquet', 'arrow'], help='by default from the file name')
+    command.add_argument('--since', type=date.fromisoformat, help='first day to export')
+    command.add_argument('--until', type=date.fromisoformat, help='day after the last to export')
+    command.add_argument('--no-stats', action='store_true', help='only the solves')
+    command.set_defaults(run=run_export)
+
+    command = commands.add_parser('import', parents=[common], help='read solves from CSV, or from csTimer exports')
+    command.add_argument('file')
+    command.set_defaults(run=run_import)
+
+    command = commands.add_parser('reindex', parents=[common], help='rebuild records and summaries')
+    command.add_argument('--all', action='store_true', help='all disciplines with solves')
+    command.set_defaults(run=run_reindex)
+
+    # Everything after the command goes to ct.bench
+    command = commands.add_parser('bench', add_help=False, help='run the benchmarks')
+    command.set_defaults(run=run_bench)
+
+    args, rest = parser.parse_known_args(args)
+    if rest and args.run is not run_bench:
+        parser.error(f'unrecognized arguments: {" ".join(rest)}')
+    args.rest = rest
+    return args.run(args)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
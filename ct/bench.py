@@ -0,0 +1,301 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+
+from sqlalchemy import create_engine
+
+from ct import db, stats
+from ct.cube import Cube
+from ct.db import Base, Discipline, UnixTime, migrate
+from ct.puzzles import puzzles
+from ct.scramble import CubeScrambler
+from ct.transfer import export_csv
+
+
+def disciplines():
+    return [
+        Discipline(puzzle, blind=blind)
+        for puzzle in puzzles
+        for blind in [False, True]
+    ]
+
+
+def fill(engine, disciplines, total, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    time = UnixTime()
+
+    def rows():
+        for i in range(total):
+            discipline = rng.choice(disciplines)
+            yield (
+                time.process_bind_param(start + timedelta(seconds=30*i), None),
+                rng.randint(5000, 60000),
+                discipline.puzzle_name,
+                discipline.blind,
+                discipline.one_handed,
+                discipline.feet,
+                False,
+                rng.random() < 0.02,
+            )
+
+    conn = engine.raw_connection()
+    conn.executemany(
+        'INSERT INTO solves (time, duration, puzzle, blind, one_handed, feet, plus_two, dnf) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        rows(),
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def measure(func, repeat=3):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time': timed(func, repeat), 'peak': peak}
+
+
+SIZES = [1000, 100000, 1000000]
+
+
+def export(discipline):
+    # The peak memory shows that the export streams
+    with open(os.devnull, 'w', newline='') as f:
+        export_csv(discipline, f)
+
+
+def append(discipline, total):
+    start = datetime(2030, 1, 1)
+    for i in range(total):
+        discipline.append(10000 + i, start + timedelta(seconds=30*i))
+    db.writer.wait()
+
+
+def toggle(discipline, solve):
+    solve.dnf = not solve.dnf
+    discipline.save(solve)
+
+
+def restore(discipline, solve):
+    # Added back after it is deleted, so that the case can be repeated
+    discipline.delete(solve)
+    discipline.push(solve)
+    db.writer.wait()
+
+
+def bench_suite(sizes=SIZES):
+    results = {}
+    for size in sizes:
+        with TemporaryDirectory() as path:
+            engine = db.connect(f'{path}/db.sqlite3')
+            targets = disciplines()
+            fill(engine, targets, size)
+
+            discipline = targets[0]
+            computer = discipline.stats_computer
+            data = discipline.data()
+            discipline.summarize()
+            middle = discipline.solves(discipline.count() // 2, 1)[0]
+            extended = stats.collection(stats.DEFAULT_STATS + ('mo3', 'ao50', 'ao1000'))
+            cases = [
+                ('Discipline.read_columns', discipline.read_columns),
+                ('Discipline.load_columns', discipline.load_columns),
+                ('Discipline.data', discipline.data),
+                ('StatsCollection.compute', lambda: computer.compute(data)),
+                ('StatsCollection.compute (+mo3 ao50 ao1000)', lambda: extended.compute(data)),
+                ('Discipline.records', lambda: list(discipline.records(recompute=True))),
+                ('Discipline.records (stored)', lambda: list(
+                    Discipline(discipline.puzzle_name, discipline.blind).records()
+                )),
+                ('Discipline.records (sql)', lambda: list(discipline.records(backend='sql'))),
+                ('Discipline.current (sql)', lambda: list(discipline.current(backend='sql'))),
+                ('Discipline.summarize', discipline.summarize),
+                ('Discipline.distribution', lambda: discipline.distribution().quantile(0.5)),
+                ('export_csv', lambda: export(discipline)),
+                ('Discipline.save (DNF of a middle solve)', lambda: toggle(discipline, middle)),
+                ('Discipline.delete (a middle solve, added back)', lambda: restore(discipline, middle)),
+                # Last, since it adds solves
+                ('Discipline.append (1000 solves)', lambda: append(discipline, 1000)),
+            ]
+            for name, func in cases:
+                results[f'{name} [{size}]'] = measure(func)
+
+            engine.dispose()
+
+    for name, puzzle in puzzles.items():
+        scrambler = puzzle['scrambler'].scrambler
+        results[f'CubeScrambler.scramble [{name}]'] = measure(
+            lambda: [scrambler.scramble() for _ in range(100)]
+        )
+    return results
+
+
+# Kept with the package, so that a run compares against it from anywhere.
+# Timings depend on the machine: store a baseline of your own with --save
+# before making changes, and compare against it after.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bench-baseline.json')
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        line = f'{name:>55}: {result["time"]*1000:10.2f} ms {result["peak"]/2**20:9.1f} MiB'
+        if name in baseline:
+            ratio = result['time'] / baseline[name]['time']
+            line = f'{line} {ratio:7.2f}x baseline'
+            if ratio > tolerance:
+                regressions.append(name)
+                line = f'{line}  REGRESSION'
+        print(line)
+    return regressions
+
+
+def query_times(engine, discipline):
+    bindings = discipline.bindings()
+    queries = [
+        ('recent 100', discipline.query(take=100, recent=True), dict(bindings, total=100)),
+        ('full history', discipline.query(), bindings),
+    ]
+    with engine.connect() as conn:
+        return [
+            (name, timed(lambda: conn.execute(query, params).fetchall()))
+            for name, query, params in queries
+        ]
+
+
+def bench_index(total=1000000):
+    with TemporaryDirectory() as path:
+        engine = create_engine(f'sqlite:///{path}/db.sqlite3')
+
+        # Start from a schema as it was before the first migration
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute('DROP INDEX ix_solves_discipline')
+
+        targets = disciplines()
+        fill(engine, targets, total)
+        before = query_times(engine, targets[0])
+
+        start = perf_counter()
+        migrate(engine)
+        migration = perf_counter() - start
+
+        after = query_times(engine, targets[0])
+        engine.dispose()
+
+    print(f'Solves table with {total} rows, {len(targets)} disciplines')
+    print(f'Migration: {migration*1000:.1f} ms')
+    for (name, old), (_, new) in zip(before, after):
+        print(f'{name:>14}: {old*1000:9.2f} ms -> {new*1000:9.2f} ms')
+
+
+def bench_cube(size=5, length=60, count=10000):
+    scrambler = CubeScrambler(size, length)
+    cube = Cube(size)
+    table = cube.table(scrambler.moves)
+
+    indices = scrambler.batch(count)
+    start = perf_counter()
+    states = cube.solved()[cube.sequences(table, indices)]
+    batch = perf_counter() - start
+
+    scrambles = scrambler.scrambles(count // 10)
+    start = perf_counter()
+    for scramble in scrambles:
+        cube.apply(scrambler.moves[i] for i in scrambler.parse(scramble))
+    single = perf_counter() - start
+
+    print(f'{size}×{size}×{size} scrambles of {length} moves')
+    print(f'{"batch":>14}: {count/batch:12.0f} states/s')
+    print(f'{"one by one":>14}: {len(scrambles)/single:12.0f} states/s')
+    return states
+
+
+# Modules that must not be loaded before the timer window is shown
+DEFERRED = ['matplotlib', 'pandas', 'numpy', 'sqlalchemy', 'ct.db', 'ct.stats', 'ct.chart']
+
+
+def import_times(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def bench_imports(module='ct.gui', top=10):
+    times = import_times(module)
+    print(f'Importing {module}: {times[module][1]/1000:.1f} ms')
+    for name, (own, cumulative) in sorted(times.items(), key=lambda kv: -kv[1][0])[:top]:
+        print(f'{name:>40}: {own/1000:8.1f} ms self, {cumulative/1000:8.1f} ms cumulative')
+
+    loaded = [name for name in DEFERRED if name in times]
+    if loaded:
+        print(f'Loaded at startup but should be deferred: {", ".join(loaded)}')
+    return not loaded
+
+
+def main(args=None):
+    parser = ArgumentParser(prog='ct.bench', description='Benchmarks for ct, run headless.')
+    parser.add_argument(
+        'sections', nargs='*', metavar='section',
+        help='suite (default), imports, index or cube',
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--baseline', default=BASELINE, help='results to compare with, from --save')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args(args)
+    sections = args.sections or ['suite']
+    unknown = set(sections) - {'suite', 'imports', 'index', 'cube'}
+    if unknown:
+        parser.error(f'unknown sections: {", ".join(sorted(unknown))}')
+
+    ok = True
+    if 'imports' in sections:
+        ok = bench_imports() and ok
+    if 'index' in sections:
+        bench_index()
+    if 'cube' in sections:
+        bench_cube()
+    if 'suite' in sections:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f'No baseline at {args.baseline}, nothing to compare with. Run with --save to store one.')
+            baseline = {}
+        results = bench_suite(args.sizes)
+        ok = not compare(results, baseline, args.tolerance) and ok
+        if args.save:
+            with open(args.baseline, 'w') as f:
+                json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+# Bytes of solves kept in memory across disciplines. With 24 bytes a solve,
+# the default holds about 2.8 million. Zero turns the cache off.
+LIMIT = 64 * 2**20
+
+
+class Columns:
+
+    # The ids, times and durations of a discipline's solves in the order of
+    # the database, by time and id, with DNFs as NaN, in arrays with room to
+    # grow at the end. The arrays given are taken as they are, which may be
+    # mapped from a snapshot. Durations are edited in place, and removed
+    # solves are only marked as such until enough of them have gathered, so
+    # that neither costs more than finding the solve. Views handed out see
+    # the edits; appends go past their end, and any other change replaces
+    # the arrays.
+
+    # Removed solves gathered before the arrays are rebuilt without them
+    COMPACT = 1024
+
+    def __init__(self, id, time, duration):
+        self.length = len(id)
+        self.id, self.time, self.duration = id, time, duration
+        self.alive = None
+        self.dead = 0
+        # Counts the changes, for what is derived from the columns and kept
+        # with them, by its users
+        self.version = 0
+        self.derived = {}
+
+    def __len__(self):
+        return self.length - self.dead
+
+    @property
+    def nbytes(self):
+        nbytes = self.id.nbytes + self.time.nbytes + self.duration.nbytes
+        return nbytes if self.alive is None else nbytes + self.alive.nbytes
+
+    def view(self, take=None, recent=False):
+        if self.dead and not take:
+            self.compact()
+        lo, hi = 0, self.length
+        if take and recent:
+            lo = self.back(hi, take)
+        elif take:
+            hi = self.forward(lo, take)
+        return self.live(lo, hi)
+
+    def live(self, lo, hi):
+        # The solves between two positions that were not removed
+        columns = self.id[lo:hi], self.time[lo:hi], self.duration[lo:hi]
+        if self.dead:
+            keep = self.alive[lo:hi]
+            columns = tuple(column[keep] for column in columns)
+        return columns
+
+    def back(self, end, count):
+        # Where the last `count` solves before a position begin
+        lo = max(end - count, 0)
+        while self.dead and lo > 0:
+            missing = count - int(np.count_nonzero(self.alive[lo:end]))
+            if missing <= 0:
+                break
+            lo = max(lo - missing, 0)
+        return lo
+
+    def forward(self, start, count):
+        # Where the first `count` solves from a position end
+        hi = min(start + count, self.length)
+        while self.dead and hi < self.length:
+            missing = count - int(np.count_nonzero(self.alive[start:hi]))
+            if missing <= 0:
+                break
+            hi = min(hi + missing, self.length)
+        return hi
+
+    def bound(self, time):
+        # The position of the first solve timed at or after the given time
+        return int(np.searchsorted(self.time[:self.length], np.datetime64(time, 'us')))
+
+    def position(self, id, time):
+        # Found among the solves of the same time. Removed solves keep their
+        # place, marked, until the arrays are rebuilt.
+        time = np.datetime64(time, 'us')
+        times = self.time[:self.length]
+        lo, hi = np.searchsorted(times, time, 'left'), np.searchsorted(times, time, 'right')
+        i = np.flatnonzero(self.id[lo:hi] == id)
+        return lo + int(i[0]) if len(i) else None
+
+    def removed(self, i):
+        return self.dead and not self.alive[i]
+
+    def insert(self, id, time, duration):
+        # New solves go at the end, unless they were timed earlier than the
+        # last one. A solve that is already there is left alone, unless it
+        # was removed.
+        time = np.datetime64(time, 'us')
+        n = self.length
+        if n and (time, id) <= (self.time[n-1], self.id[n-1]):
+            i = self.position(id, time)
+            if i is not None:
+                if self.removed(i):
+                    self.writable()
+                    self.alive[i] = True
+                    self.duration[i] = duration
+                    self.dead -= 1
+                    self.version += 1
+                return
+            times = self.time[:n]
+            lo, hi = np.searchsorted(times, time, 'left'), np.searchsorted(times, time, 'right')
+            i = lo + int(np.searchsorted(self.id[lo:hi], id))
+            self.id = np.insert(self.id[:n], i, id)
+            self.time = np.insert(self.time[:n], i, time)
+            self.duration = np.insert(self.duration[:n], i, duration)
+            if self.alive is not None:
+                self.alive = np.insert(self.alive[:n], i, True)
+            self.length += 1
+            self.version += 1
+            return
+        if n == len(self.id):
+            self.id, self.time, self.duration = (
+                grow(column, max(2 * n, 16)) for column in (self.id, self.time, self.duration)
+            )
+        if self.alive is not None and n == len(self.alive):
+            self.alive = grow(self.alive, len(self.id))
+        self.id[n], self.time[n], self.duration[n] = id, time, duration
+        if self.alive is not None:
+            self.alive[n] = True
+        self.length += 1
+        self.version += 1
+
+    def update(self, id, time, duration):
+        i = self.position(id, time)
+        if i is not None and not self.removed(i):
+            self.writable()
+            self.duration[i] = duration
+            self.version += 1
+
+    def remove(self, id, time):
+        i = self.position(id, time)
+        if i is not None and not self.removed(i):
+            if self.alive is None:
+                self.alive = np.ones(len(self.id), dtype=bool)
+            self.alive[i] = False
+            self.dead += 1
+            self.version += 1
+            if self.dead > self.COMPACT:
+                self.compact()
+
+    def writable(self):
+        # Arrays mapped from a snapshot are copied before the first edit
+        if not self.duration.flags.writeable:
+            self.duration = np.array(self.duration)
+
+    def compact(self):
+        ids, times, durations = self.live(0, self.length)
+        self.id, self.time, self.duration = np.array(ids), np.array(times), np.array(durations)
+        self.length = len(self.id)
+        self.alive = None
+        self.dead = 0
+
+
+def grow(column, capacity):
+    result = np.empty(capacity, dtype=column.dtype)
+    result[:len(column)] = column
+    return result
+
+
+class Cache:
+
+    # Columns by discipline, the least recently used dropped first once they
+    # take more than the limit
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def view(self, key, take=None, recent=False):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key].view(take, recent)
+
+    def put(self, key, columns):
+        with self.lock:
+            self.entries[key] = columns
+            self.evict()
+
+    def drop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def entry(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def change(self, key, method, *args):
+        with self.lock:
+            if key in self.entries:
+                getattr(self.entries[key], method)(*args)
+                self.evict()
+
+    def evict(self):
+        total = sum(columns.nbytes for columns in self.entries.values())
+        while self.entries and total > LIMIT:
+            _, columns = self.entries.popitem(last=False)
+            total -= columns.nbytes
+
+
+solves = Cache()
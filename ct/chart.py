@@ -0,0 +1,174 @@
+import matplotlib
+matplotlib.use('Qt5Agg')
+
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
+
+from PyQt5.QtWidgets import QSizePolicy
+
+import numpy as np
+
+from ct.util import format_time
+
+
+def decimate(values, lo, hi, buckets):
+    # Indices of the minimum and maximum of each of `buckets` equal slices of
+    # values[lo:hi], in order. Drawn at one bucket per pixel this looks the
+    # same as the full data, outliers included.
+    total = hi - lo
+    if total <= 2 * buckets:
+        return np.arange(lo, hi)
+
+    size = -(-total // buckets)
+    padded = np.full(size * buckets, np.nan)
+    padded[:total] = values[lo:hi]
+    padded = padded.reshape(buckets, size)
+    finite = ~np.isnan(padded)
+    low = np.where(finite, padded, np.inf).argmin(axis=1)
+    high = np.where(finite, padded, -np.inf).argmax(axis=1)
+
+    offsets = np.arange(buckets) * size + lo
+    indices = np.sort(np.stack([low, high], axis=1), axis=1) + offsets[:, None]
+    indices = indices.ravel()
+    return indices[indices < hi]
+
+
+class ChartWidget(FigureCanvas):
+
+    # The full history is kept in arrays, but only a decimated copy of the
+    # visible range is handed to matplotlib, recomputed when the view or the
+    # size changes. New solves are drawn on top of a cached background by
+    # blitting, until the next full redraw takes them in.
+
+    def __init__(self, data, parent=None, width=5, height=4, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        axes = fig.add_subplot(111)
+        self.axes = axes
+
+        self.index = data.index.to_numpy()
+        self.values = [data[k].to_numpy(dtype=float) / 1000 for k in data.columns]
+        self.drawn = len(self.index)
+        self.background = None
+
+        scatter_kwargs = {
+            'alpha': 0.3,
+            'edgecolor': 'none',
+            'color': 'black',
+        }
+        plot_kwargs = [
+            {
+                'color': '#0099ff',
+                'linestyle': 'solid',
+                'linewidth': 2,
+                'alpha': 0.6,
+            },
+            {
+                'color': '#0000bb',
+                'linestyle': 'solid',
+                'linewidth': 2,
+            },
+            {
+                'color': '#ff0000',
+                'linestyle': 'solid',
+                'linewidth': 2,
+            }
+        ]
+
+        self.artists = [axes.scatter([], [], label=data.columns[0], **scatter_kwargs)]
+        self.tails = [axes.scatter([], [], animated=True, **scatter_kwargs)]
+        for kwargs, k in zip(plot_kwargs, data.columns[1:]):
+            self.artists.extend(axes.plot([], [], label=k, **kwargs))
+            self.tails.extend(axes.plot([], [], animated=True, **kwargs))
+        self.values = self.values[:len(self.artists)]
+
+        axes.xaxis.set_major_formatter(FuncFormatter(self.format_x))
+        axes.yaxis.set_major_formatter(FuncFormatter(lambda y, pos: format_time(y * 1000)))
+        axes.legend()
+        axes.grid()
+
+        super(ChartWidget, self).__init__(fig)
+        self.setParent(parent)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.updateGeometry()
+
+        self.rescale()
+        axes.callbacks.connect('xlim_changed', lambda axes: self.decimate())
+        self.mpl_connect('resize_event', lambda event: self.decimate())
+        self.mpl_connect('draw_event', self.on_draw)
+
+    def format_x(self, x, pos):
+        i = int(round(x))
+        if 0 <= i < len(self.index):
+            return str(self.index[i].astype('datetime64[D]'))
+        return ''
+
+    def rescale(self):
+        # Leave room on the right for new solves to be blitted into
+        length = len(self.index)
+        self.axes.set_xlim(0, length - 1 + max(10, length // 50), emit=False)
+        self.decimate()
+
+        finite = np.concatenate([column[np.isfinite(column)] for column in self.values])
+        if len(finite):
+            bottom, top = finite.min(), finite.max()
+            margin = 0.05 * (top - bottom) or 1
+            self.axes.set_ylim(bottom - margin, top + margin)
+
+    def decimate(self):
+        length = len(self.index)
+        left, right = self.axes.get_xlim()
+        lo = min(max(int(left), 0), length)
+        hi = min(max(int(right) + 2, lo), length)
+        buckets = max(int(self.axes.bbox.width), 1)
+
+        for artist, values in zip(self.artists, self.values):
+            indices = decimate(values, lo, hi, buckets)
+            if artist is self.artists[0]:
+                artist.set_offsets(np.column_stack([indices, values[indices]]))
+            else:
+                artist.set_data(indices, values[indices])
+
+        self.drawn = length
+        for tail in self.tails:
+            self.set_tail(tail, [], [])
+        self.draw_idle()
+
+    def set_tail(self, tail, xs, ys):
+        if tail is self.tails[0]:
+            tail.set_offsets(np.column_stack([xs, ys]))
+        else:
+            tail.set_data(xs, ys)
+
+    def on_draw(self, event):
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        self.draw_tails()
+
+    def draw_tails(self):
+        for tail in self.tails:
+            self.axes.draw_artist(tail)
+
+    def new_solve(self, time, values):
+        self.index = np.append(self.index, np.datetime64(time, 'us'))
+        self.values = [
+            np.append(column, value / 1000)
+            for column, value in zip(self.values, values)
+        ]
+
+        position = len(self.index) - 1
+        bottom, top = self.axes.get_ylim()
+        in_view = all(np.isnan(v) or bottom <= v / 1000 <= top for v in values)
+        if self.background is None or position > self.axes.get_xlim()[1] or not in_view:
+            self.rescale()
+            return
+
+        # Draw the solves appended since the last full redraw, joined to the
+        # last point drawn before them
+        start = max(self.drawn - 1, 0)
+        self.set_tail(self.tails[0], np.arange(self.drawn, position + 1), self.values[0][self.drawn:])
+        for tail, column in zip(self.tails[1:], self.values[1:]):
+            self.set_tail(tail, np.arange(start, position + 1), column[start:])
+
+        self.restore_region(self.background)
+        self.draw_tails()
+        self.blit(self.axes.bbox)
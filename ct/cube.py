@@ -0,0 +1,105 @@
+import numpy as np
+
+
+# Each face by outward normal, and the directions of increasing column and
+# row when looking at it, U and D with F towards the bottom and top of the
+# view respectively
+FACES = {
+    'U': ((0, 1, 0), (1, 0, 0), (0, 0, 1)),
+    'R': ((1, 0, 0), (0, 0, -1), (0, -1, 0)),
+    'F': ((0, 0, 1), (1, 0, 0), (0, -1, 0)),
+    'D': ((0, -1, 0), (1, 0, 0), (0, 0, -1)),
+    'L': ((-1, 0, 0), (0, 0, 1), (0, -1, 0)),
+    'B': ((0, 0, -1), (-1, 0, 0), (0, -1, 0)),
+}
+
+
+class Cube:
+
+    # Facelet model of an N×N×N cube. A state is an array of 6N² colors, face
+    # by face in the order of FACES, each face row by row. Moves are
+    # permutations acting by gathering, new = state[perm], so applying p and
+    # then q is state[p][q] = state[p[q]], and any move sequence composes
+    # into a single permutation.
+
+    def __init__(self, size):
+        self.size = size
+        self.faces = list(FACES)
+
+        # Sticker positions in doubled coordinates, so that cubie centers are
+        # integers in -(N-1)..N-1 and stickers lie on the planes ±N
+        offsets = np.arange(size) * 2 - (size - 1)
+        positions = []
+        for normal, right, down in FACES.values():
+            normal, right, down = (np.array(v) for v in (normal, right, down))
+            for r in offsets:
+                for c in offsets:
+                    positions.append(normal * size + right * c + down * r)
+        self.positions = np.array(positions)
+        self.lookup = {tuple(p): i for i, p in enumerate(self.positions)}
+        self.perms = {}
+
+    def solved(self):
+        return np.repeat(np.arange(6, dtype=np.uint8), self.size ** 2)
+
+    def identity(self):
+        return np.arange(len(self.positions))
+
+    def turn(self, side, width, amount):
+        key = (side, width, amount)
+        if key not in self.perms:
+            normal = np.array(FACES[side][0])
+            layer = self.positions @ normal >= self.size + 1 - 2 * width
+
+            # A clockwise quarter turn seen from the face is a rotation by -90
+            # degrees about its normal: v -> n(n·v) - n×v
+            rotated = self.positions.copy()
+            for _ in range(amount % 4):
+                rotated[layer] = (
+                    np.outer(rotated[layer] @ normal, normal)
+                    - np.cross(normal, rotated[layer])
+                )
+
+            perm = self.identity()
+            for src, pos in enumerate(rotated):
+                perm[self.lookup[tuple(pos)]] = src
+            self.perms[key] = perm
+        return self.perms[key]
+
+    def move(self, move):
+        return self.turn(move.side, move.width, move.amount)
+
+    def sequence(self, moves):
+        perm = self.identity()
+        for move in moves:
+            perm = perm[self.move(move)]
+        return perm
+
+    def apply(self, moves, state=None):
+        if state is None:
+            state = self.solved()
+        return state[self.sequence(moves)]
+
+    def table(self, moves):
+        return np.array([self.move(m) for m in moves])
+
+    def sequences(self, table, indices):
+        # Composes many move sequences at once, given as rows of indices into
+        # a table of move permutations
+        perms = table[indices[:, 0]]
+        for step in range(1, indices.shape[1]):
+            perms = np.take_along_axis(perms, table[indices[:, step]], axis=1)
+        return perms
+
+    def is_solved(self, state):
+        faces = state.reshape(6, -1)
+        return bool((faces == faces[:, :1]).all())
+
+    def key(self, state):
+        return state.tobytes()
+
+    def faces_of(self, state):
+        return {
+            name: face.reshape(self.size, self.size)
+            for name, face in zip(self.faces, state.reshape(6, -1))
+        }
@@ -1,223 +1,124 @@
-from collections import namedtuple
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, DateTime, String, Boolean, Float, text as _text, bindparam
-from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta
+import atexit
+from sqlalchemy import (
+    create_engine, Column, Integer, Date, DateTime, String, Boolean, Float, Index
+)
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from xdg import BaseDirectory
-from math import isnan
 
-import numpy as np
-import pandas as pd
-
-from ct.scramble import CubeScrambler
+from ct import cache
+from ct.discipline import Discipline
+from ct.persist import Writer
 from ct.util import format_time
-from ct.stats import default_stats
 
 
 DATA_PATH = BaseDirectory.save_data_path('ct')
-engine = create_engine(f'sqlite:///{DATA_PATH}/db.sqlite3')
 Base = declarative_base()
 
-Session = sessionmaker(bind=engine)
-Session.configure(bind=engine)
-session = Session()
-
-
-puzzles = {
-    '2': {
-        'name': '2×2×2',
-        'inspection': 15,
-        'scrambler': CubeScrambler(2, 25),
-    },
-    '3': {
-        'default': True,
-        'name': '3×3×3',
-        'inspection': 15,
-        'scrambler': CubeScrambler(3, 25),
-    },
-    '4': {
-        'name': '4×4×4',
-        'inspection': 15,
-        'scrambler': CubeScrambler(4, 40),
-    },
-    '5': {
-        'name': '5×5×5',
-        'inspection': 15,
-        'scrambler': CubeScrambler(5, 60),
-    },
-}
-
 
-def text(s):
-    sql = _text(s)
+def connect(path=None):
+    global engine, writer, snapshots, _ids
+    if path is None:
+        path = f'{DATA_PATH}/db.sqlite3'
+    close()
+    cache.solves.clear()
+    # Reads take a connection from the pool for one operation at a time, on
+    # whichever thread they run
+    engine = create_engine(
+        f'sqlite:///{path}', poolclass=QueuePool, connect_args={'check_same_thread': False},
+    )
+    migrate(engine)
+    engine.execute('PRAGMA journal_mode = WAL')
+    writer = Writer(engine)
+    snapshots = f'{path}-snapshots'
+    _ids = iter(())
+    return engine
+
+
+@atexit.register
+def close():
+    # Waits for the queued writes
+    if 'writer' in globals():
+        writer.close()
+
+
+def __getattr__(name):
+    # The default database is opened on first use, unless connect() has
+    # been called with another one first
+    if name in ('engine', 'writer', 'snapshots'):
+        connect()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Ids reserved at a time for the solves of a session
+ID_BLOCK = 100
+
+_ids = iter(())
+
+
+def next_id():
+    # Solves are written in the background, together with the records that
+    # refer to them, so their ids are reserved beforehand
+    global _ids
+    id = next(_ids, None)
+    if id is None:
+        _ids = iter(reserve(ID_BLOCK))
+        id = next(_ids)
+    return id
+
+
+def reserve(count):
+    # Consecutive ids taken from SQLite's AUTOINCREMENT counter in a
+    # transaction of their own. SQLite never hands them out again, so no
+    # other writer, in this process or another, can insert a solve with one.
+    if 'writer' not in globals():
+        connect()
+    with engine.begin() as conn:
+        conn.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'solves', coalesce(max(id), 0) FROM solves "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'solves')"
+        )
+        conn.execute("UPDATE sqlite_sequence SET seq = seq + ? WHERE name = 'solves'", count)
+        last = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'solves'").scalar()
+    return range(last - count + 1, last + 1)
 
-    if 'puzzle' in sql._bindparams:
-        sql = sql.bindparams(bindparam('puzzle', String))
-    for param in set(sql._bindparams) & {'blind', 'one_handed', 'feet'}:
-        sql = sql.bindparams(bindparam(param, Boolean))
 
-    return sql
+EPOCH = datetime(1970, 1, 1)
 
 
-Record = namedtuple('Record', ['name', 'when', 'duration'])
+class UnixTime(TypeDecorator):
 
+    # Naive UTC datetimes stored as integer microseconds since the epoch, so
+    # that times can be read straight into NumPy arrays
 
-class Discipline:
+    impl = Integer
 
-    def __init__(self, puzzle, blind=False, one_handed=False, feet=False):
-        self.puzzle_name = puzzle
-        self.puzzle = puzzles[puzzle]
-        self.blind = blind
-        self.one_handed = one_handed
-        self.feet = feet
-        self._records = []
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return (value - EPOCH) // timedelta(microseconds=1)
 
-    @property
-    def inspection(self):
-        if self.blind:
-            return 0
-        return self.puzzle['inspection']
-
-    @property
-    def name(self):
-        args = [self.puzzle['name']]
-        if self.blind:
-            args.append('BLD')
-        if self.one_handed:
-            args.append('OH')
-        if self.feet:
-            args.append('FEET')
-        return ' '.join(args)
-
-    @property
-    def stats_computer(self):
-        return default_stats
-
-    def scramble(self):
-        self.last_scramble = self.puzzle['scrambler'].scramble()
-        return self.last_scramble
-
-    def append(self, duration, time=None, remarks=None, scramble=None):
-        if time is None:
-            time = datetime.utcnow()
-        if scramble is None and hasattr(self, 'last_scramble'):
-            scramble = self.last_scramble
-
-        records = list(self.records())
-
-        solve = Solve(
-            time=time,
-            duration=duration,
-            puzzle=self.puzzle_name,
-            blind=self.blind,
-            one_handed=self.one_handed,
-            feet=self.feet,
-            remarks=remarks,
-            scramble=scramble
-        )
-        session.add(solve)
-        session.commit()
-
-        new_records = []
-        self._records = []
-        for rec, cur in zip(records, self.current()):
-            if cur.duration < rec.duration:
-                rec = cur
-                new_records.append(cur)
-            self._records.append(rec)
-
-        return solve, new_records
-
-    def solve_fits(self, solve):
-        return all([
-            self.puzzle_name == solve.puzzle,
-            self.blind == solve.blind,
-            self.one_handed == solve.one_handed,
-            self.feet == solve.feet,
-        ])
-
-    def save(self, solve):
-        assert self.solve_fits(solve)
-        self._records = []
-        session.commit()
-
-    def delete(self, solve):
-        assert self.solve_fits(solve)
-        self._records = []
-        session.delete(solve)
-        session.commit()
-
-    def bindings(self):
-        return {
-            'puzzle': self.puzzle_name,
-            'blind': self.blind,
-            'one_handed': self.one_handed,
-            'feet': self.feet,
-        }
-
-    def historical(self):
-        computer = self.stats_computer
-        data = self.data()
-        return computer.compute(data)
-
-    def records(self, recompute=False):
-        if recompute or not self._records:
-            data = self.historical()
-            self._records = []
-            for k in data.columns:
-                when = data[k].argmin()
-                if isinstance(when, float) and isnan(when):
-                    when = None
-                self._records.append(Record(k, when, data[k].min()))
-        yield from self._records
-
-    def current(self):
-        computer = self.stats_computer
-        data = self.data(take=computer.minimum, recent=True)
-        data = computer.compute(data)
-        for k in data.columns:
-            yield Record(k, data.index[-1], data[k][-1])
-
-    def data(self, take=None, recent=False):
-        query = f"""
-        SELECT
-            time,
-            CASE WHEN dnf = 1 THEN NULL ELSE duration END AS duration
-        FROM solves
-        WHERE
-            puzzle = :puzzle AND
-            blind = :blind AND
-            one_handed = :one_handed AND
-            feet = :feet
-        ORDER BY time {'DESC' if recent else 'ASC'}
-        """
-
-        if take:
-            query = f'{query}\n LIMIT :total'
-        if recent:
-            query = f'SELECT * FROM ({query}) ORDER BY time ASC'
-
-        query = text(query)
-        query = query.columns(time=DateTime, duration=Integer)
-
-        bindings = self.bindings()
-        if take:
-            bindings['total'] = take
-
-        data = [(np.datetime64(row[0], 's'), row[1])
-                for row in engine.execute(query, bindings)]
-        data = np.array(data, dtype=[('time', 'datetime64[s]'), ('duration', '>f4')])
-        return pd.Series(data=data['duration'], index=data['time'])
-
-    def __repr__(self):
-        return self.name
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return EPOCH + timedelta(microseconds=value)
 
 
 class Solve(Base):
     __tablename__ = 'solves'
+    __table_args__ = (
+        Index(
+            'ix_solves_discipline',
+            'puzzle', 'blind', 'one_handed', 'feet', 'time', 'id', 'duration', 'dnf',
+        ),
+        {'sqlite_autoincrement': True},
+    )
 
     id = Column(Integer, primary_key=True)
-    time = Column(DateTime, nullable=False)
+    time = Column(UnixTime, nullable=False)
     duration = Column(Integer, nullable=False)
     puzzle = Column(String, nullable=False)
     blind = Column(Boolean, nullable=False, default=False)
@@ -228,6 +129,24 @@ class Solve(Base):
     remarks = Column(String)
     scramble = Column(String)
 
+
+class SolveRow:
+
+    # A row of the solves table, in the order of its columns. Solves are
+    # read and written with Core statements only, so they are plain objects
+    # rather than instances tracked by a session.
+
+    __slots__ = [column.name for column in Solve.__table__.columns]
+
+    def __init__(self, *values, **kwargs):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def values(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
     @property
     def discipline(self):
         return Discipline(self.puzzle, self.blind, self.one_handed, self.feet)
@@ -237,9 +156,120 @@ class Solve(Base):
         base = format_time(self.duration)
         if self.plus_two:
             base = f'{base} (+2)'
-        if self.dnf:
-            base = f'<s>{base}</s>'
         return base
 
 
-Base.metadata.create_all(engine)
+class StoredRecord(Base):
+    __tablename__ = 'records'
+    __table_args__ = (
+        Index('ix_records_discipline', 'puzzle', 'blind', 'one_handed', 'feet', 'name', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    puzzle = Column(String, nullable=False)
+    blind = Column(Boolean, nullable=False)
+    one_handed = Column(Boolean, nullable=False)
+    feet = Column(Boolean, nullable=False)
+    name = Column(String, nullable=False)
+    duration = Column(Float)
+    time = Column(DateTime)
+    solve_id = Column(Integer)
+
+
+class StoredSummary(Base):
+    __tablename__ = 'summaries'
+    __table_args__ = (
+        Index('ix_summaries_discipline', 'puzzle', 'blind', 'one_handed', 'feet', 'day', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    puzzle = Column(String, nullable=False)
+    blind = Column(Boolean, nullable=False)
+    one_handed = Column(Boolean, nullable=False)
+    feet = Column(Boolean, nullable=False)
+    day = Column(Date, nullable=False)
+    count = Column(Integer, nullable=False)
+    dnfs = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    sketch = Column(String, nullable=False)
+
+
+def summary_rows(bindings, summaries):
+    return [
+        dict(
+            bindings,
+            day=(EPOCH + timedelta(days=day)).date(),
+            count=summary.moments.count,
+            dnfs=summary.dnfs,
+            mean=summary.moments.mean,
+            m2=summary.moments.m2,
+            sketch=summary.sketch.dumps(),
+        )
+        for day, summary in summaries.items()
+    ]
+
+
+def _add_discipline_index(conn):
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS ix_solves_discipline ON solves '
+        '(puzzle, blind, one_handed, feet, time, id, duration, dnf)'
+    )
+
+
+def _store_unix_time(conn):
+    conn.execute(
+        "UPDATE solves SET time = "
+        "CAST(strftime('%s', time) AS INTEGER) * 1000000 + CAST(substr(time, 21, 6) AS INTEGER) "
+        "WHERE typeof(time) = 'text'"
+    )
+
+
+def _summarize_solves(conn):
+    import numpy as np
+    from ct.distribution import summarize
+
+    disciplines = conn.execute(
+        'SELECT DISTINCT puzzle, blind, one_handed, feet FROM solves'
+    ).fetchall()
+    for puzzle, blind, one_handed, feet in disciplines:
+        columns = conn.execute(
+            'SELECT group_concat(time), group_concat(duration), group_concat(dnf) FROM solves '
+            'WHERE puzzle = ? AND blind = ? AND one_handed = ? AND feet = ?',
+            (puzzle, blind, one_handed, feet),
+        ).fetchone()
+        time, duration, dnf = (np.fromstring(c, dtype=np.int64, sep=',') for c in columns)
+        bindings = dict(puzzle=puzzle, blind=bool(blind), one_handed=bool(one_handed), feet=bool(feet))
+        summaries = summarize(time // 86400000000, duration, dnf.astype(bool))
+        conn.execute(StoredSummary.__table__.insert(), summary_rows(bindings, summaries))
+
+
+def _autoincrement_ids(conn):
+    # Ids are reserved from the AUTOINCREMENT counter, which SQLite only
+    # keeps for tables declared with it, so the table is built again
+    columns = ', '.join(column.name for column in Solve.__table__.columns)
+    conn.execute('DROP INDEX IF EXISTS ix_solves_discipline')
+    conn.execute('ALTER TABLE solves RENAME TO solves_old')
+    Solve.__table__.create(conn)
+    conn.execute(f'INSERT INTO solves ({columns}) SELECT {columns} FROM solves_old')
+    conn.execute('DROP TABLE solves_old')
+
+
+# Each migration upgrades the schema by one version, recorded in SQLite's
+# user_version. New tables come from create_all; only changes to existing
+# tables need a migration.
+migrations = [
+    _add_discipline_index,
+    _store_unix_time,
+    _summarize_solves,
+    _autoincrement_ids,
+]
+
+
+def migrate(engine):
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        version = conn.execute('PRAGMA user_version').scalar()
+        for version, migration in enumerate(migrations[version:], start=version+1):
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
@@ -0,0 +1,574 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import isnan
+import json
+
+from ct.puzzles import puzzles
+from ct.util import lazy_import
+
+# The database and statistics stacks are only loaded once a discipline's
+# solves are first needed, so that the timer can start without them
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+sa = lazy_import('sqlalchemy')
+db = lazy_import('ct.db')
+cache = lazy_import('ct.cache')
+persist = lazy_import('ct.persist')
+snapshot = lazy_import('ct.snapshot')
+stats = lazy_import('ct.stats')
+distribution = lazy_import('ct.distribution')
+
+
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+@lru_cache()
+def stat_sets():
+    # Stats to keep per discipline, by name, e.g.
+    # {"3×3×3 BLD": ["single", "mo3", "ao5"]}
+    from xdg import BaseDirectory
+    path = BaseDirectory.load_first_config('ct', 'stats.json')
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def day_number(time):
+    # Days since the epoch, for a date or datetime
+    return time.toordinal() - EPOCH_ORDINAL
+
+
+class Discipline:
+
+    def __init__(self, puzzle, blind=False, one_handed=False, feet=False):
+        self.puzzle_name = puzzle
+        self.puzzle = puzzles[puzzle]
+        self.blind = blind
+        self.one_handed = one_handed
+        self.feet = feet
+        self._state = None
+        self._summaries = {}
+
+    @property
+    def inspection(self):
+        if self.blind:
+            return 0
+        return self.puzzle['inspection']
+
+    @property
+    def name(self):
+        args = [self.puzzle['name']]
+        if self.blind:
+            args.append('BLD')
+        if self.one_handed:
+            args.append('OH')
+        if self.feet:
+            args.append('FEET')
+        return ' '.join(args)
+
+    @property
+    def stats_computer(self):
+        return stats.collection(tuple(stat_sets().get(self.name, stats.DEFAULT_STATS)))
+
+    def scramble(self):
+        self.last_scramble = self.puzzle['scrambler'].scramble()
+        return self.last_scramble
+
+    def append(self, duration, time=None, remarks=None, scramble=None):
+        solve = self.add(duration, time, remarks, scramble)
+        return solve, self.push(solve)
+
+    def add(self, duration, time=None, remarks=None, scramble=None):
+        # The solve is given its id and written by push, in one transaction
+        # with the records and summary that follow from it
+        if time is None:
+            time = datetime.utcnow()
+        if scramble is None and hasattr(self, 'last_scramble'):
+            scramble = self.last_scramble
+
+        return db.SolveRow(
+            id=None,
+            time=time,
+            duration=duration,
+            puzzle=self.puzzle_name,
+            blind=self.blind,
+            one_handed=self.one_handed,
+            feet=self.feet,
+            plus_two=False,
+            dnf=False,
+            remarks=remarks,
+            scramble=scramble
+        )
+
+    def push(self, solve):
+        # Everything is read before the solve is written
+        state = self.state()
+        if solve.id is None:
+            solve.id = db.next_id()
+        unit = self.unit()
+        unit.submit(db.Solve.__table__.insert(), solve.values())
+        self.tally(solve, unit)
+        when, value = solve.time, float(solve.duration)
+        change = ('insert', solve.id, when, value)
+        blocks = self.blocks()
+        cache.solves.change(self.key, *change)
+        columns = cache.solves.entry(self.key)
+        # Solves are in the order of the database, by time and id
+        if state.follows(when, solve.id):
+            new_records = state.push(solve.id, when, value)
+            if blocks is not None and columns is not None:
+                blocks.push(columns, solve.id, when, [record.duration for record in state.current])
+        else:
+            # A solve that comes before the last one changes windows that
+            # may be folded into the bests already
+            if blocks is not None and columns is not None:
+                blocks.refresh(columns, solve.time)
+            previous = state.records
+            state = self.amend(change) or self.recompute(change)
+            new_records = [
+                record for record, old in zip(state.records, previous)
+                if record.duration < old.duration
+            ]
+        self.store(state, unit)
+        db.writer.commit(unit)
+        self.expire(solve)
+        return new_records
+
+    def solve_fits(self, solve):
+        return all([
+            self.puzzle_name == solve.puzzle,
+            self.blind == solve.blind,
+            self.one_handed == solve.one_handed,
+            self.feet == solve.feet,
+        ])
+
+    def save(self, solve):
+        assert self.solve_fits(solve)
+        table = db.Solve.__table__
+        unit = self.unit()
+        unit.submit(table.update().where(table.c.id == solve.id).values(
+            duration=solve.duration,
+            plus_two=solve.plus_two,
+            dnf=solve.dnf,
+            remarks=solve.remarks,
+        ))
+        value = np.nan if solve.dnf else float(solve.duration)
+        self.apply(solve, ('update', solve.id, solve.time, value), unit)
+
+    def delete(self, solve):
+        assert self.solve_fits(solve)
+        table = db.Solve.__table__
+        unit = self.unit()
+        unit.submit(table.delete().where(table.c.id == solve.id))
+        self.apply(solve, ('remove', solve.id, solve.time), unit)
+
+    def apply(self, solve, change, unit):
+        # The change to the solve is written along with the records and
+        # summary, so what is read from the database is still without it and
+        # the change is made to that in memory. A change is a method of
+        # cache.Columns and its arguments.
+        state = self.state()
+        blocks = self.blocks()
+        cache.solves.change(self.key, *change)
+        columns = cache.solves.entry(self.key)
+        if blocks is not None and columns is not None:
+            blocks.refresh(columns, change[2])
+        if change[0] == 'remove':
+            done = state.remove(solve.id)
+        else:
+            done = state.update(solve.id, change[3])
+        if not done:
+            state = self.amend(change) or self.recompute(change)
+        self.store(state, unit)
+        self.summarize(solve, removed=change[0] == 'remove', writer=unit)
+        db.writer.commit(unit)
+        self.expire(solve)
+
+    def amend(self, change):
+        # After a change outside the tail of the state, the bests are found
+        # among those of blocks of window positions, of which only the ones
+        # around the solve were evaluated again. The solves are loaded into
+        # memory for this, without the change if they were not there yet.
+        # None if they cannot be kept there.
+        if cache.solves.entry(self.key) is None:
+            self.columns()
+            cache.solves.change(self.key, *change)
+        blocks = self.blocks(build=True)
+        if blocks is None:
+            return None
+        computer = self.stats_computer
+        ids, times, values = cache.solves.view(self.key, 2*computer.minimum-1, recent=True)
+        self._state = stats.StatsState(computer, values, times.tolist(), ids, blocks.bests())
+        return self._state
+
+    def blocks(self, build=False):
+        # The bests over blocks of the cached solves, kept with them and in
+        # step as long as every change to them is passed on. Built if asked
+        # and missing or behind; None if the solves are not cached.
+        columns = cache.solves.entry(self.key)
+        if columns is None:
+            return None
+        computer = self.stats_computer
+        blocks = columns.derived.get(computer)
+        if blocks is not None and blocks.version == columns.version:
+            return blocks
+        if not build:
+            return None
+        blocks = columns.derived[computer] = stats.Blocks(computer, columns)
+        return blocks
+
+    def recompute(self, change):
+        ids, times, values = self.changed(change)
+        self._state = stats.StatsState(self.stats_computer, values, times.tolist(), ids)
+        return self._state
+
+    def changed(self, change, take=None):
+        # The last `take` solves, or all of them, with a change made that may
+        # not have been written yet. Columns read from the database are
+        # without it, the cached ones already have it, and making it again
+        # does nothing. A removal needs one more solve to leave `take`.
+        recent = bool(take)
+        extra = 1 if take and change[0] == 'remove' else 0
+        columns = self.columns(take and take + extra, recent)
+        cache.solves.change(self.key, *change)
+        columns = cache.Columns(*columns)
+        getattr(columns, change[0])(*change[1:])
+        return columns.view(take, recent)
+
+    def expire(self, solve):
+        # The snapshot is out of date if it holds the solve, or should: ids
+        # may be reserved before a snapshot is taken and written after it.
+        # Solves with a larger id than any in it are read from the database
+        # when it is loaded.
+        last_id = snapshot.last_id(self.snapshot_path)
+        if last_id is not None and solve.id <= last_id:
+            snapshot.remove(self.snapshot_path)
+
+    def unit(self):
+        return persist.Unit(rollback=self.forget)
+
+    def forget(self):
+        # Called on the writer thread when changes to the discipline were
+        # rolled back, and on the worker when a job failed. The solves and
+        # stats kept in memory may have them, and so may records stored since,
+        # so all are read again from the solves.
+        cache.solves.drop(self.key)
+        self._state = None
+        self._summaries = {}
+        table = db.StoredRecord.__table__
+        db.writer.submit(table.delete().where(self.condition(table)))
+
+    @property
+    def key(self):
+        return (self.puzzle_name, self.blind, self.one_handed, self.feet)
+
+    @property
+    def snapshot_path(self):
+        return snapshot.path(db.snapshots, self.key)
+
+    def bindings(self):
+        return {
+            'puzzle': self.puzzle_name,
+            'blind': self.blind,
+            'one_handed': self.one_handed,
+            'feet': self.feet,
+        }
+
+    def condition(self, table):
+        return sa.and_(*(table.c[key] == value for key, value in self.bindings().items()))
+
+    def historical(self):
+        computer = self.stats_computer
+        data = self.data()
+        return computer.compute(data)
+
+    def state(self, recompute=False):
+        if recompute or self._state is None:
+            computer = self.stats_computer
+            bests = None if recompute else self.stored()
+            if bests is not None:
+                ids, times, values = self.columns(take=2*computer.minimum-1, recent=True)
+                self._state = stats.StatsState(computer, values, times.tolist(), ids, bests)
+            else:
+                ids, times, values = self.columns()
+                self._state = stats.StatsState(computer, values, times.tolist(), ids)
+                self.store(self._state)
+        return self._state
+
+    def stored(self):
+        db.writer.wait()
+        table = db.StoredRecord.__table__
+        with db.engine.connect() as conn:
+            rows = {row.name: row for row in conn.execute(table.select().where(self.condition(table)))}
+        if any(s.name not in rows for s in self.stats_computer.stats):
+            return None
+        bests = OrderedDict()
+        for s in self.stats_computer.stats:
+            row = rows[s.name]
+            if row.duration is None:
+                bests[s.name] = (np.nan, None, None)
+            else:
+                bests[s.name] = (row.duration, row.time, row.solve_id)
+        return bests
+
+    def store(self, state, writer=None):
+        writer = writer or db.writer
+        table = db.StoredRecord.__table__
+        writer.submit(table.delete().where(self.condition(table)))
+        writer.submit(table.insert(), [
+            dict(
+                self.bindings(),
+                name=name,
+                duration=None if isnan(value) else float(value),
+                time=when,
+                solve_id=None if id is None else int(id),
+            )
+            for name, (value, when, id) in state.bests.items()
+        ])
+
+    def tally(self, solve, writer=None):
+        day = day_number(solve.time)
+        if day not in self._summaries:
+            rows = self.summaries(day, day + 1)
+            self._summaries[day] = rows.get(day, distribution.Summary())
+        self._summaries[day].add(solve.duration, solve.dnf)
+        self.store_summaries({day: self._summaries[day]}, writer=writer)
+
+    def summarize(self, solve=None, removed=False, writer=None):
+        # Summaries are rebuilt from the solves, for the day of the given
+        # solve or for all days. The solve is taken as given, or as removed,
+        # whatever the database has for it.
+        if solve is None:
+            _, times, values = self.columns()
+            days = times.astype('datetime64[D]').astype(np.int64)
+            self._summaries = distribution.summarize(days, values, np.isnan(values))
+            self.store_summaries(self._summaries, replace=True)
+            return
+
+        day = day_number(solve.time)
+        start = db.EPOCH + timedelta(days=day)
+        table = db.Solve.__table__
+        query = sa.select([table.c.id, table.c.duration, table.c.dnf]).where(sa.and_(
+            self.condition(table), table.c.time >= start, table.c.time < start + timedelta(days=1),
+        ))
+        db.writer.wait()
+        summary = distribution.Summary()
+        with db.engine.connect() as conn:
+            for id, duration, dnf in conn.execute(query):
+                if id != solve.id:
+                    summary.add(duration, dnf)
+        if not removed:
+            summary.add(solve.duration, solve.dnf)
+        self._summaries[day] = summary
+        self.store_summaries({day: summary}, writer=writer)
+
+    def summaries(self, start=None, end=None):
+        table = db.StoredSummary.__table__
+        query = table.select().where(self.condition(table))
+        if start is not None:
+            query = query.where(table.c.day >= (db.EPOCH + timedelta(days=start)).date())
+        if end is not None:
+            query = query.where(table.c.day < (db.EPOCH + timedelta(days=end)).date())
+        db.writer.wait()
+        with db.engine.connect() as conn:
+            return {
+                day_number(row.day): distribution.Summary(
+                    distribution.Moments(row.count, row.mean, row.m2),
+                    distribution.Sketch.loads(row.sketch),
+                    row.dnfs,
+                )
+                for row in conn.execute(query)
+            }
+
+    def store_summaries(self, summaries, replace=False, writer=None):
+        writer = writer or db.writer
+        table = db.StoredSummary.__table__
+        delete = table.delete().where(self.condition(table))
+        if not replace:
+            days = [(db.EPOCH + timedelta(days=day)).date() for day in summaries]
+            delete = delete.where(table.c.day.in_(days))
+        writer.submit(delete)
+        if summaries:
+            writer.submit(table.insert(), db.summary_rows(self.bindings(), summaries))
+
+    def distribution(self, start=None, end=None):
+        # The distribution of the solves between two dates, end excluded,
+        # merged from the stored summaries by day
+        start = None if start is None else day_number(start)
+        end = None if end is None else day_number(end)
+        total = distribution.Summary()
+        for summary in self.summaries(start, end).values():
+            total = total.merge(summary)
+        return total
+
+    def reindex(self):
+        # The solves may have been changed behind the cache's back
+        cache.solves.drop(self.key)
+        snapshot.remove(self.snapshot_path)
+        self.state(recompute=True)
+        self.summarize()
+
+    def records(self, recompute=False, backend='numpy'):
+        # With the sql backend, the records are computed by SQLite over the
+        # whole history, and nothing is kept
+        if backend == 'sql':
+            yield from self.sql_stats('records')
+            return
+        yield from self.state(recompute).records
+
+    def current(self, backend='numpy'):
+        if backend == 'sql':
+            yield from self.sql_stats('current')
+            return
+        if self._state:
+            yield from self._state.current
+            return
+        computer = self.stats_computer
+        _, times, values = self.columns(take=computer.minimum, recent=True)
+        when = times[-1].tolist() if len(times) else None
+        for name, column in computer.rolling(values).items():
+            yield stats.Record(name, when, column[-1] if len(column) else np.nan)
+
+    def sql_stats(self, kind):
+        from ct import sqlstats
+        db.writer.wait()
+        with db.engine.connect() as conn:
+            return getattr(sqlstats, kind)(conn.connection, self.stats_computer, self.bindings())
+
+    def count(self):
+        table = db.Solve.__table__
+        db.writer.wait()
+        with db.engine.connect() as conn:
+            return conn.execute(
+                sa.select([sa.func.count()]).select_from(table).where(self.condition(table))
+            ).scalar()
+
+    def solves(self, offset=0, limit=None, recent=False, before=None, after=None):
+        # Oldest first. With recent, or only a bound before, they are counted
+        # from the newest. The bounds are (time, id) pairs, which SQLite finds
+        # in the discipline index rather than counting the solves up to them.
+        table = db.Solve.__table__
+        position = sa.tuple_(table.c.time, table.c.id)
+        query = table.select().where(self.condition(table))
+        if before is not None:
+            query = query.where(position < before)
+        if after is not None:
+            query = query.where(position > after)
+        recent = recent or (before is not None and after is None)
+        if recent:
+            query = query.order_by(table.c.time.desc(), table.c.id.desc())
+        else:
+            query = query.order_by(table.c.time, table.c.id)
+        db.writer.wait()
+        with db.engine.connect() as conn:
+            solves = [db.SolveRow(*row) for row in conn.execute(query.offset(offset).limit(limit))]
+        return solves[::-1] if recent else solves
+
+    def query(self, take=None, recent=False, after=None):
+        # Solves after a given id are found by the primary key, and there are
+        # usually few of them
+        query = f"""
+        SELECT id, time, duration, dnf
+        FROM solves {'NOT INDEXED' if after is not None else ''}
+        WHERE
+            {'id > :after AND' if after is not None else ''}
+            puzzle = :puzzle AND
+            blind = :blind AND
+            one_handed = :one_handed AND
+            feet = :feet
+        ORDER BY time {'DESC' if recent else 'ASC'}, id {'DESC' if recent else 'ASC'}
+        """
+
+        if take:
+            query = f'{query}\n LIMIT :total'
+        if recent:
+            query = f'SELECT * FROM ({query}) ORDER BY time ASC, id ASC'
+
+        return query
+
+    def data(self, take=None, recent=False, ids=False):
+        id, time, duration = self.columns(take, recent)
+        series = pd.Series(data=duration, index=time)
+        if ids:
+            return series, id
+        return series
+
+    def columns(self, take=None, recent=False):
+        # Ids, times and durations of the solves in order, with DNFs as NaN.
+        # Views of the cached columns, not to be written to, if the whole
+        # history has been read before; a few recent solves are read from the
+        # database rather than loading it all.
+        columns = cache.solves.view(self.key, take, recent)
+        if columns is not None:
+            return columns
+        if take:
+            return self.read_columns(take, recent)
+        id, time, duration = self.load_columns()
+        cache.solves.put(self.key, cache.Columns(id, time, duration))
+        return id, time, duration
+
+    def load_columns(self):
+        # The whole history, from the snapshot and the solves added since. The
+        # snapshot is brought up to date if there were any, by adding them
+        # in place if there is room, and rebuilt if they do not simply
+        # follow it.
+        path = self.snapshot_path
+        stored = snapshot.load(path)
+        if stored is not None:
+            last_id, *columns = stored
+            newer = self.read_columns(after=last_id)
+            if not len(newer[0]):
+                return tuple(columns)
+            id, time, _ = columns
+            if not len(id) or (newer[1][0], newer[0][0]) >= (time[-1], id[-1]):
+                if snapshot.append(path, *newer):
+                    return tuple(snapshot.load(path)[1:])
+                columns = tuple(np.concatenate(pair) for pair in zip(columns, newer))
+                snapshot.save(path, *columns)
+                return columns
+
+        columns = self.read_columns()
+        if len(columns[0]) >= snapshot.MINIMUM:
+            snapshot.save(path, *columns)
+        else:
+            snapshot.remove(path)
+        return columns
+
+    def read_columns(self, take=None, recent=False, after=None):
+        bindings = self.bindings()
+        if take:
+            bindings['total'] = take
+        if after is not None:
+            bindings['after'] = after
+
+        # Have SQLite pack each column into a single string, which NumPy then
+        # parses in one go, so no Python object is created per row. Aggregate
+        # order is not guaranteed, hence the sort (a no-op check in practice).
+        query = f"""
+        SELECT
+            group_concat(id),
+            group_concat(time),
+            group_concat(CASE WHEN dnf THEN -1 ELSE duration END)
+        FROM ({self.query(take, recent, after)})
+        """
+        db.writer.wait()
+        with db.engine.connect() as conn:
+            cursor = conn.connection.cursor()
+            columns = cursor.execute(query, bindings).fetchone()
+            cursor.close()
+        id, time, duration = (
+            np.fromstring(column or '', dtype=np.int64, sep=',')
+            for column in columns
+        )
+        if np.any((time[1:] < time[:-1]) | ((time[1:] == time[:-1]) & (id[1:] < id[:-1]))):
+            order = np.lexsort((id, time))
+            id, time, duration = id[order], time[order], duration[order]
+
+        time = time.astype('datetime64[us]')
+        duration = np.where(duration < 0, np.nan, duration)
+        return id, time, duration
+
+    def __repr__(self):
+        return self.name
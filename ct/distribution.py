@@ -0,0 +1,165 @@
+from collections import Counter
+from math import ceil, log, sqrt
+import json
+
+import numpy as np
+
+
+# Relative accuracy of the quantiles: 0.1%, about a hundredth at ten seconds
+ALPHA = 0.001
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+LOG_GAMMA = log(GAMMA)
+
+
+def bucket(duration):
+    return ceil(log(max(duration, 1)) / LOG_GAMMA)
+
+
+def buckets(durations):
+    return np.ceil(np.log(np.maximum(durations, 1)) / LOG_GAMMA).astype(np.int64)
+
+
+class Moments:
+
+    # Welford's running mean and sum of squared deviations
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if not count:
+            return Moments()
+        delta = other.mean - self.mean
+        return Moments(
+            count,
+            self.mean + delta * other.count / count,
+            self.m2 + other.m2 + delta * delta * self.count * other.count / count,
+        )
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return np.nan
+        return sqrt(self.m2 / (self.count - 1))
+
+
+class Sketch:
+
+    # Counts of durations in logarithmic buckets, as in DDSketch. Every
+    # quantile is within ALPHA of a true one, however many durations were
+    # added, and sketches merge by adding their counts.
+
+    def __init__(self, counts=None):
+        self.counts = Counter(counts or {})
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def add(self, duration):
+        self.counts[bucket(duration)] += 1
+
+    def merge(self, other):
+        return Sketch(self.counts + other.counts)
+
+    def quantile(self, q):
+        total = self.count
+        if not total:
+            return np.nan
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return 2 * GAMMA ** index / (GAMMA + 1)
+
+    def below(self, duration):
+        # Durations in the bucket of the limit itself can not be told apart,
+        # and are left out
+        limit = bucket(duration)
+        return sum(count for index, count in self.counts.items() if index < limit)
+
+    def dumps(self):
+        return json.dumps(sorted(self.counts.items()))
+
+    @classmethod
+    def loads(cls, text):
+        return cls(dict(json.loads(text)))
+
+
+class Summary:
+
+    # The distribution of a set of solves: moments and a sketch of the
+    # completed ones, and the number of DNFs
+
+    def __init__(self, moments=None, sketch=None, dnfs=0):
+        self.moments = moments or Moments()
+        self.sketch = sketch or Sketch()
+        self.dnfs = dnfs
+
+    def add(self, duration, dnf=False):
+        if dnf:
+            self.dnfs += 1
+        else:
+            self.moments.add(duration)
+            self.sketch.add(duration)
+
+    def merge(self, other):
+        return Summary(
+            self.moments.merge(other.moments),
+            self.sketch.merge(other.sketch),
+            self.dnfs + other.dnfs,
+        )
+
+    @property
+    def count(self):
+        return self.moments.count
+
+    @property
+    def mean(self):
+        return self.moments.mean if self.count else np.nan
+
+    @property
+    def std(self):
+        return self.moments.std
+
+    @property
+    def median(self):
+        return self.sketch.quantile(0.5)
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    def below(self, duration):
+        return self.sketch.below(duration)
+
+
+def summarize(days, durations, dnfs):
+    # Summaries by day of whole arrays of solves at once
+    keys, inverse = np.unique(days, return_inverse=True)
+    summaries = [
+        Summary(dnfs=int(count))
+        for count in np.bincount(inverse, weights=dnfs, minlength=len(keys))
+    ]
+
+    done = ~dnfs
+    inverse, durations = inverse[done], durations[done].astype(float)
+    counts = np.bincount(inverse, minlength=len(keys))
+    means = np.bincount(inverse, weights=durations, minlength=len(keys)) / np.maximum(counts, 1)
+    m2s = np.bincount(inverse, weights=(durations - means[inverse]) ** 2, minlength=len(keys))
+    for summary, count, mean, m2 in zip(summaries, counts, means, m2s):
+        summary.moments = Moments(int(count), float(mean), float(m2))
+
+    pairs, counts = np.unique(np.stack([inverse, buckets(durations)]), axis=1, return_counts=True)
+    for (i, index), count in zip(pairs.T, counts):
+        summaries[i].sketch.counts[int(index)] = int(count)
+    return dict(zip(keys.tolist(), summaries))
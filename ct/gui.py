@@ -1,76 +1,22 @@
-import matplotlib
-matplotlib.use('Qt5Agg')
-
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-
-from PyQt5.QtGui import QIcon, QPixmap
+from PyQt5.QtGui import QFont, QIcon, QPixmap
 from PyQt5.QtWidgets import (
     QApplication, QHBoxLayout, QMainWindow, QVBoxLayout, QWidget, QPushButton,
-    QButtonGroup, QLabel, QFrame, QScrollArea, QMenu, QDialog, QGridLayout,
-    QSizePolicy, QMessageBox
+    QButtonGroup, QLabel, QFrame, QTableView, QHeaderView, QMenu, QDialog,
+    QGridLayout, QMessageBox
 )
-from PyQt5.QtCore import Qt, QEvent
+from PyQt5.QtCore import Qt, QAbstractListModel, QEvent, QModelIndex, QTimer
 
-from ct.db import puzzles, Discipline
+from ct.discipline import Discipline
+from ct.puzzles import puzzles
 from ct.util import format_time
 import ct.timing as timing
 
+from collections import OrderedDict
+from functools import partial
 from os.path import abspath, dirname, join
 import sys
 
 
-class ChartWidget(FigureCanvas):
-
-    def __init__(self, data, parent=None, width=5, height=4, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        axes = fig.add_subplot(111)
-
-        index = data['Single'].index
-        xs = list(range(len(index)))
-        axes.scatter(xs, data['Single'] / 1000, alpha=0.3, edgecolor='none', color='black', label='Single')
-        data = data.drop('Single', 'columns')
-
-        plot_kwargs = [
-            {
-                'color': '#0099ff',
-                'linestyle': 'solid',
-                'linewidth': 2,
-                'alpha': 0.6,
-            },
-            {
-                'color': '#0000bb',
-                'linestyle': 'solid',
-                'linewidth': 2,
-            },
-            {
-                'color': '#ff0000',
-                'linestyle': 'solid',
-                'linewidth': 2,
-            }
-        ]
-        for kwargs, (k, v) in zip(plot_kwargs, data.items()):
-            axes.plot(xs, v / 1000, label=k, **kwargs)
-
-        axes.set_xlim(xs[0], xs[-1])
-        axes.legend()
-
-        xticks = [i for i in axes.get_xticks() if int(i) < len(index)]
-        xlabels = [index[int(i)].strftime('%Y-%m-%d') for i in xticks]
-        axes.set_xticks(xticks)
-        axes.set_xticklabels(xlabels)
-
-        ylabels = [format_time(t * 1000) for t in axes.get_yticks()]
-        axes.set_yticklabels(ylabels)
-
-        axes.grid()
-
-        super(ChartWidget, self).__init__(fig)
-        self.setParent(parent)
-        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        self.updateGeometry()
-
-
 class StatsWidget(QWidget):
 
     def __init__(self, records, current):
@@ -128,8 +74,40 @@ class HistoryDialog(QDialog):
         self.showMaximized()
 
         self.setLayout(QHBoxLayout())
-        self.layout().addWidget(StatsWidget(discipline.records(), discipline.current()))
-        self.layout().addWidget(ChartWidget(discipline.historical(), parent=self))
+        self.stats = QLabel('Loading…')
+        self.stats.setAlignment(Qt.AlignCenter)
+        self.layout().addWidget(self.stats)
+        self.chart = None
+
+        timing.history_changed.register(self.history_changed)
+        timing.stats_changed.register(self.stats_changed)
+        timing.request_history()
+
+    def history_changed(self, data, records, current):
+        # Matplotlib is only needed here, so it is not loaded at startup
+        from ct.chart import ChartWidget
+
+        self.chart = ChartWidget(data, parent=self)
+        self.set_stats(records, current)
+        self.layout().addWidget(self.chart)
+
+    def set_stats(self, records, current):
+        stats = StatsWidget(records, current)
+        self.layout().replaceWidget(self.stats, stats)
+        self.stats.deleteLater()
+        self.stats = stats
+
+    def stats_changed(self, solve, records, current, new_records):
+        if self.chart is None:
+            return
+        self.set_stats(records, current)
+        if solve is not None:
+            self.chart.new_solve(solve.time, [record.duration for record in current])
+
+    def done(self, result):
+        timing.history_changed.unregister(self.history_changed)
+        timing.stats_changed.unregister(self.stats_changed)
+        super(HistoryDialog, self).done(result)
 
 
 class DisciplineChoiceWidget(QWidget):
@@ -209,80 +187,215 @@ class DisciplineChoiceWidget(QWidget):
         self.make_discipline()
 
 
-class ResultWidget(QFrame):
+class ResultsModel(QAbstractListModel):
 
-    def __init__(self, master, solve):
-        super(ResultWidget, self).__init__(master)
-        self.master = master
-        self.setFrameShape(QFrame.StyledPanel)
-        self.solve = solve
+    # Solves of the current discipline, newest first, fetched from the
+    # database a page at a time as rows are shown. Pages count from the
+    # oldest solve, so new solves leave them in place. Only the most
+    # recently used pages are kept. The count and the pages are read on the
+    # worker, after the changes made before them, and rows show blank until
+    # their page arrives.
 
-        self.setLayout(QHBoxLayout())
+    PAGE_SIZE = 100
+    MAX_PAGES = 5
 
-        self.time = QLabel(solve.formatted_duration)
-        self.layout().addWidget(self.time)
+    def __init__(self):
+        super(ResultsModel, self).__init__()
+        self.discipline = None
+        self.total = 0
+        self.added = 0
+        self.pages = OrderedDict()
+        self.loading = {}
+
+    def reset(self, discipline):
+        self.beginResetModel()
+        self.discipline = discipline
+        self.total = 0
+        self.added = 0
+        self.pages.clear()
+        self.loading.clear()
+        self.endResetModel()
+        self.request(None, discipline.count)
+
+    def request(self, key, func):
+        # The result of a request that was withdrawn meanwhile is dropped
+        token = self.loading[key] = object()
+        timing.read(partial(self.loaded, key, token), func)
+
+    def loaded(self, key, token, result):
+        if self.loading.get(key) is not token:
+            return
+        del self.loading[key]
+        if key is None:
+            # Solves added while counting are pushed after the count is read
+            self.beginResetModel()
+            self.total = result + self.added
+            self.endResetModel()
+            return
+        self.pages[key] = result
+        self.evict()
+        last = self.total - 1 - key * self.PAGE_SIZE
+        first = max(last - len(result) + 1, 0)
+        self.dataChanged.emit(self.index(first), self.index(last))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.total
+
+    def solve(self, row):
+        page, offset = divmod(self.total - 1 - row, self.PAGE_SIZE)
+        if page not in self.pages:
+            if page not in self.loading:
+                self.load(page)
+            return None
+        self.pages.move_to_end(page)
+        solves = self.pages[page]
+        return solves[offset] if offset < len(solves) else None
+
+    def load(self, page):
+        # Next to a page that is already there, the solves are found from
+        # its first or last one, and otherwise counted from the nearer end.
+        # The bound is taken on the worker, where a new solve has its id.
+        discipline = self.discipline
+        first = page * self.PAGE_SIZE
+        end = min(first + self.PAGE_SIZE, self.total)
+        if page + 1 in self.pages:
+            solve = self.pages[page + 1][0]
+            self.request(page, lambda: discipline.solves(
+                limit=end - first, before=(solve.time, solve.id)))
+        elif page - 1 in self.pages:
+            solve = self.pages[page - 1][-1]
+            self.request(page, lambda: discipline.solves(
+                limit=end - first, after=(solve.time, solve.id)))
+        elif self.total - end < first:
+            skip = self.total - end
+            self.request(page, lambda: discipline.solves(skip, end - first, recent=True))
+        else:
+            self.request(page, lambda: discipline.solves(first, end - first))
+
+    def evict(self):
+        if len(self.pages) > self.MAX_PAGES:
+            self.pages.popitem(last=False)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.total:
+            return None
+        if role not in (Qt.DisplayRole, Qt.FontRole):
+            return None
+        solve = self.solve(index.row())
+        if solve is None:
+            return None
+        if role == Qt.DisplayRole:
+            return solve.formatted_duration
+        font = QFont()
+        font.setStrikeOut(solve.dnf)
+        return font
+
+    def changed(self, row):
+        self.dataChanged.emit(self.index(row), self.index(row))
+
+    def prepend(self, solve):
+        if None in self.loading:
+            self.added += 1
+            return
+        page, offset = divmod(self.total, self.PAGE_SIZE)
+        # A read of the page that is under way would miss the solve
+        self.loading.pop(page, None)
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        if page in self.pages:
+            self.pages[page].append(solve)
+        elif offset == 0:
+            # The solve starts a page, which needs no reading then
+            self.pages[page] = [solve]
+            self.evict()
+        self.total += 1
+        self.endInsertRows()
+
+    def remove(self, row):
+        page = (self.total - 1 - row) // self.PAGE_SIZE
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.total -= 1
+        for later in [p for p in self.pages if p >= page]:
+            del self.pages[later]
+        for later in [p for p in self.loading if p is not None and p >= page]:
+            del self.loading[later]
+        self.endRemoveRows()
+
+
+class ResultsList(QTableView):
+
+    # A one-column table rather than a list view, since QListView lays out
+    # every row again whenever one is added
+    def __init__(self):
+        super(ResultsList, self).__init__()
+        self.setMaximumWidth(250)
+        self.setShowGrid(False)
+        self.setSelectionBehavior(QTableView.SelectRows)
+        self.horizontalHeader().hide()
+        self.horizontalHeader().setStretchLastSection(True)
+        self.verticalHeader().hide()
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.context_menu)
+
+        self.results = ResultsModel()
+        self.setModel(self.results)
+
+        timing.new_solve.register(self.new_solve)
+        timing.discipline_changed.register(self.discipline_changed)
+        # Solves whose writing failed were rolled back, and are listed no more
+        timing.persist_failed.register(self.persist_failed)
+
+        # Loading the history needs the database, which can wait until the
+        # window is up
+        QTimer.singleShot(0, self.discipline_changed)
+
+    def new_solve(self, solve):
+        self.results.prepend(solve)
+
+    def discipline_changed(self):
+        self.results.reset(timing.discipline)
+
+    def persist_failed(self, error, operations):
+        self.results.reset(timing.discipline)
+
+    def context_menu(self, pos):
+        index = self.indexAt(pos)
+        if not index.isValid():
+            return
+        solve = self.results.solve(index.row())
+        if solve is None:
+            return
 
-    def contextMenuEvent(self, event):
         menu = QMenu(self)
 
         plus_two = menu.addAction('+2')
         plus_two.setCheckable(True)
-        plus_two.setChecked(self.solve.plus_two)
+        plus_two.setChecked(solve.plus_two)
 
         dnf = menu.addAction('DNF')
         dnf.setCheckable(True)
-        dnf.setChecked(self.solve.dnf)
+        dnf.setChecked(solve.dnf)
 
         delete = menu.addAction('Delete')
 
-        selected = menu.exec_(self.mapToGlobal(event.pos()))
+        selected = menu.exec_(self.viewport().mapToGlobal(pos))
         if selected == plus_two:
-            self.solve.plus_two = not self.solve.plus_two
-            if self.solve.plus_two:
-                self.solve.duration += 2000
+            solve.plus_two = not solve.plus_two
+            if solve.plus_two:
+                solve.duration += 2000
             else:
-                self.solve.duration -= 2000
-            timing.discipline.save(self.solve)
+                solve.duration -= 2000
+            timing.save(solve)
+            self.results.changed(index.row())
         elif selected == dnf:
-            self.solve.dnf = not self.solve.dnf
-            timing.discipline.save(self.solve)
+            solve.dnf = not solve.dnf
+            timing.save(solve)
+            self.results.changed(index.row())
         elif selected == delete:
-            timing.discipline.delete(self.solve)
-            self.master.remove_widget(self)
-
-        self.time.setText(self.solve.formatted_duration)
-
-
-class ResultsList(QScrollArea):
-
-    def __init__(self):
-        super(ResultsList, self).__init__()
-        self.setMaximumWidth(250)
-
-        central = QWidget()
-        self.setWidget(central)
-        self.setWidgetResizable(True)
-
-        self.layout = QVBoxLayout(central)
-        self.layout.addStretch()
-
-        self.widgets = []
-
-        timing.new_solve.register(self.new_solve)
-        timing.discipline_changed.register(self.discipline_changed)
-
-    def new_solve(self, solve, records):
-        self.widgets.append(ResultWidget(self, solve))
-        self.layout.insertWidget(0, self.widgets[-1])
-
-    def remove_widget(self, widget):
-        self.layout.removeWidget(widget)
-        widget.setParent(None)
-
-    def discipline_changed(self):
-        for w in self.widgets:
-            self.remove_widget(w)
-        self.widgets = []
+            timing.delete(solve)
+            self.results.remove(index.row())
 
 
 class TimerWidget(QWidget):
@@ -354,7 +467,25 @@ class MainWindow(QMainWindow):
         self.setWindowTitle('Cube Timer')
         self.setCentralWidget(MasterWidget())
 
-        # timing.new_solve.register(self.new_solve)
+        # timing.stats_changed.register(self.stats_changed)
+        timing.persist_failed.register(self.persist_failed)
+
+        # The state is loaded on the worker while the first solve is under
+        # way, rather than when it is pushed
+        QTimer.singleShot(0, timing.request_stats)
+
+    def changeEvent(self, event):
+        if event.type() == QEvent.WindowStateChange:
+            timing.set_visible(self.isVisible() and not self.isMinimized())
+        super(MainWindow, self).changeEvent(event)
+
+    def showEvent(self, event):
+        timing.set_visible(not self.isMinimized())
+        super(MainWindow, self).showEvent(event)
+
+    def hideEvent(self, event):
+        timing.set_visible(False)
+        super(MainWindow, self).hideEvent(event)
 
     def eventFilter(self, obj, event):
         if event.type() == QEvent.KeyPress and event.text() in [' ', 'q', 'h', 'c']:
@@ -369,19 +500,27 @@ class MainWindow(QMainWindow):
             return True
         return super(MainWindow, self).eventFilter(obj, event)
 
-    def new_solve(self, solve, records):
-        if records:
+    def stats_changed(self, solve, records, current, new_records):
+        if new_records:
             msgbox = QMessageBox()
             msgbox.setStyleSheet('QLabel { font-weight: bold; }')
             msgbox.setWindowTitle('New records set')
             msgbox.setIcon(QMessageBox.Information)
             text = []
-            for r in records:
+            for r in new_records:
                 text.append(f'<p>{r.name}: {format_time(r.duration)}<p>')
             msgbox.setText(''.join(text))
             msgbox.exec_()
 
 
+    def persist_failed(self, error, operations):
+        changes = f'{len(operations)} changes' if operations else 'Changes'
+        QMessageBox.warning(
+            self, 'Could not save',
+            f'{changes} could not be written to the database:\n\n{error}',
+        )
+
+
 def run_gui():
     app = QApplication(sys.argv)
     win = MainWindow()
@@ -0,0 +1,95 @@
+from queue import Queue, Empty
+from threading import Thread
+
+from ct.util import EventHandler
+
+
+# Called on the writer thread with the exception and the operations that
+# were rolled back, whenever a batch fails to commit
+failed = EventHandler()
+
+
+class Unit:
+
+    # Statements that are committed in the same transaction, and what to
+    # call on the writer thread if they are rolled back instead
+
+    def __init__(self, rollback=None):
+        self.operations = []
+        self.rollback = rollback
+
+    def submit(self, statement, params=None):
+        self.operations.append((statement, params))
+
+
+class Writer:
+
+    # Changes to the database are queued and written by a single thread, in
+    # the order they were submitted. Each transaction takes everything that
+    # queued up while the previous one was committing, so the number of
+    # commits does not grow with the rate of solves. A unit is never split
+    # across transactions.
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.queue = Queue()
+        self.thread = None
+
+    def submit(self, statement, params=None):
+        unit = Unit()
+        unit.submit(statement, params)
+        self.commit(unit)
+
+    def commit(self, unit):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name='ct-writer', daemon=True)
+            self.thread.start()
+        self.queue.put(unit)
+
+    @property
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    def wait(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def batch(self):
+        batch = [self.queue.get()]
+        while batch[-1] is not None:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        with self.engine.connect() as conn:
+            while True:
+                batch = self.batch()
+                units = [unit for unit in batch if unit is not None]
+                operations = [op for unit in units for op in unit.operations]
+                try:
+                    with conn.begin():
+                        for statement, params in operations:
+                            if params is None:
+                                conn.execute(statement)
+                            else:
+                                conn.execute(statement, params)
+                except Exception as error:
+                    for unit in units:
+                        if unit.rollback is not None:
+                            unit.rollback()
+                    failed(error, operations)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+                if batch[-1] is None:
+                    return
+                # Nothing of a batch is kept while waiting for the next
+                del batch, units, operations
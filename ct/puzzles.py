@@ -0,0 +1,29 @@
+from ct.scramble import CubeScrambler, ScrambleQueue
+
+
+# Number of scrambles kept ready per puzzle
+SCRAMBLE_DEPTH = 5
+
+puzzles = {
+    '2': {
+        'name': '2×2×2',
+        'inspection': 15,
+        'scrambler': ScrambleQueue(CubeScrambler(2, 25), SCRAMBLE_DEPTH),
+    },
+    '3': {
+        'default': True,
+        'name': '3×3×3',
+        'inspection': 15,
+        'scrambler': ScrambleQueue(CubeScrambler(3, 25), SCRAMBLE_DEPTH),
+    },
+    '4': {
+        'name': '4×4×4',
+        'inspection': 15,
+        'scrambler': ScrambleQueue(CubeScrambler(4, 40), SCRAMBLE_DEPTH),
+    },
+    '5': {
+        'name': '5×5×5',
+        'inspection': 15,
+        'scrambler': ScrambleQueue(CubeScrambler(5, 60), SCRAMBLE_DEPTH),
+    },
+}
@@ -1,5 +1,14 @@
 from abc import abstractmethod
+from queue import Empty, Queue
 from random import choice
+from threading import Thread
+
+from ct.util import lazy_import
+
+np = lazy_import('numpy')
+
+
+AXES = {side: group for group in ['FB', 'UD', 'LR'] for side in group}
 
 
 class CubeMove:
@@ -26,11 +35,7 @@ class CubeMove:
         return self.width
 
     def same_axis(self, other):
-        return self.side in {
-            side: group
-            for group in ['FB', 'UD', 'LR']
-            for side in group
-        }[other.side]
+        return AXES[self.side] == AXES[other.side]
 
     def same_layers(self, other):
         if not self.same_axis(other):
@@ -53,44 +58,124 @@ class CubeMove:
 
 class Scrambler:
 
-    def scramble(self):
-        moves = []
-        while len(moves) < self.length:
-            candidate = self.random_move()
-            if self.valid(moves, candidate):
-                moves.append(candidate)
-        return ' '.join(str(m) for m in moves)
-
     @abstractmethod
-    def random_move(self):
-        pass
-
-    @abstractmethod
-    def valid(self, moves, candidate):
+    def scramble(self):
         pass
 
 
 class CubeScrambler(Scrambler):
 
+    # Moves are numbered, and the state of a scramble is the axis of its
+    # trailing run of same-axis moves together with a bitmask of the slices
+    # used in that run. Valid moves, those that do not turn a slice again
+    # within the run, are drawn directly from a table per state.
+
     def __init__(self, size=3, length=25):
         super(CubeScrambler, self).__init__()
         self.size = size
         self.length = length
 
-    def random_move(self):
-        widths = list(range(1, self.size // 2 + 1))
-        amounts = [1, 2, -1]
-        sides = 'FBUDLR'
-        return CubeMove(choice(sides), choice(widths), choice(amounts), self.size)
-
-    def valid(self, moves, candidate):
-        valid = True
-        slices = {candidate.slice}
-        for m in moves[::-1]:
-            if not m.same_axis(candidate):
-                break
-            if m.slice in slices:
-                valid = False
-                break
-            slices.add(m.slice)
-        return valid
+        self.moves = [
+            CubeMove(side, width, amount, size)
+            for side in 'FBUDLR'
+            for width in range(1, size // 2 + 1)
+            for amount in [1, 2, -1]
+        ]
+        self.names = [str(m) for m in self.moves]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.axes = [AXES[m.side] for m in self.moves]
+        self.bits = [1 << m.slice for m in self.moves]
+        self.tables = {}
+        self.batch_tables = None
+
+    def parse(self, scramble):
+        return [self.index[name] for name in scramble.split()]
+
+    def valid_moves(self, state):
+        if state not in self.tables:
+            axis, mask = state
+            self.tables[state] = [
+                i for i, (a, bit) in enumerate(zip(self.axes, self.bits))
+                if a != axis or not mask & bit
+            ]
+        return self.tables[state]
+
+    def next_state(self, state, move):
+        axis, mask = state
+        if self.axes[move] != axis:
+            return (self.axes[move], self.bits[move])
+        return (axis, mask | self.bits[move])
+
+    def scramble(self):
+        state = (None, 0)
+        moves = []
+        for _ in range(self.length):
+            move = choice(self.valid_moves(state))
+            state = self.next_state(state, move)
+            moves.append(move)
+        return ' '.join(self.names[m] for m in moves)
+
+    def make_batch_tables(self):
+        states = [(None, 0)]
+        index = {(None, 0): 0}
+        for state in states:
+            for move in self.valid_moves(state):
+                new = self.next_state(state, move)
+                if new not in index:
+                    index[new] = len(states)
+                    states.append(new)
+
+        nmoves = len(self.moves)
+        valid = np.zeros((len(states), nmoves), dtype=np.intp)
+        counts = np.zeros(len(states), dtype=np.intp)
+        transitions = np.zeros((len(states), nmoves), dtype=np.intp)
+        for i, state in enumerate(states):
+            moves = self.valid_moves(state)
+            valid[i, :len(moves)] = moves
+            counts[i] = len(moves)
+            for move in moves:
+                transitions[i, move] = index[self.next_state(state, move)]
+        return valid, counts, transitions
+
+    def batch(self, count, rng=None):
+        if self.batch_tables is None:
+            self.batch_tables = self.make_batch_tables()
+        valid, counts, transitions = self.batch_tables
+        if rng is None:
+            rng = np.random.default_rng()
+
+        states = np.zeros(count, dtype=np.intp)
+        moves = np.empty((count, self.length), dtype=np.intp)
+        for step in range(self.length):
+            picks = (rng.random(count) * counts[states]).astype(np.intp)
+            moves[:, step] = valid[states, picks]
+            states = transitions[states, moves[:, step]]
+        return moves
+
+    def scrambles(self, count, rng=None):
+        names = np.array(self.names, dtype=object)
+        return [' '.join(row) for row in names[self.batch(count, rng)]]
+
+
+class ScrambleQueue:
+
+    # Keeps up to `depth` scrambles ready, generated by a worker thread that
+    # starts on the first request and refills the queue as it is drawn from
+
+    def __init__(self, scrambler, depth=5):
+        self.scrambler = scrambler
+        self.queue = Queue(maxsize=depth)
+        self.thread = None
+
+    def fill(self):
+        while True:
+            self.queue.put(self.scrambler.scramble())
+
+    def scramble(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.fill, daemon=True)
+            self.thread.start()
+        try:
+            return self.queue.get_nowait()
+        except Empty:
+            return self.scrambler.scramble()
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+
+# A snapshot holds the ids, times and durations of a discipline's solves in
+# order, DNFs as NaN, one column after the other behind a fixed header. Each
+# column is mapped straight into an array, so nothing is read until it is
+# used. The columns have room for more solves than they hold, so that newer
+# ones can be added in place.
+MAGIC = b'ctsnap03'
+HEADER = np.dtype([('magic', 'S8'), ('count', '<i8'), ('last_id', '<i8'), ('capacity', '<i8')])
+HEADER_SIZE = 64
+COLUMNS = [np.dtype('<i8'), np.dtype('<M8[us]'), np.dtype('<f8')]
+
+# Smaller disciplines are read from the database quickly enough
+MINIMUM = 10000
+
+# Room left for newer solves, as a fraction of those written, and at least
+SPARE = 1 / 8
+MINIMUM_SPARE = 1024
+
+
+def path(directory, key):
+    puzzle, *flags = key
+    return os.path.join(directory, f'{puzzle}-{"".join(str(int(f)) for f in flags)}.snapshot')
+
+
+def offsets(capacity):
+    offset = HEADER_SIZE
+    for dtype in COLUMNS:
+        yield offset
+        offset += capacity * dtype.itemsize
+
+
+def header(path):
+    # The number of solves, the largest id and the capacity, or None
+    try:
+        header = np.fromfile(path, dtype=HEADER, count=1)
+    except (FileNotFoundError, ValueError):
+        return None
+    if len(header) != 1 or header['magic'][0] != MAGIC:
+        return None
+    count, last_id, capacity = (int(header[name][0]) for name in ('count', 'last_id', 'capacity'))
+    if count > capacity or os.path.getsize(path) != HEADER_SIZE + capacity * sum(d.itemsize for d in COLUMNS):
+        return None
+    return count, last_id, capacity
+
+
+def last_id(path):
+    stored = header(path)
+    return None if stored is None else stored[1]
+
+
+def load(path):
+    # The largest id in the snapshot and its columns, or None
+    stored = header(path)
+    if stored is None:
+        return None
+    count, last_id, capacity = stored
+    if not count:
+        return (last_id, *(np.empty(0, dtype=d) for d in COLUMNS))
+    return (last_id, *(
+        np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        for dtype, offset in zip(COLUMNS, offsets(capacity))
+    ))
+
+
+def encode(count, last_id, capacity):
+    header = np.zeros(1, dtype=HEADER)
+    header['magic'] = MAGIC
+    header['count'] = count
+    header['last_id'] = last_id
+    header['capacity'] = capacity
+    return header.tobytes().ljust(HEADER_SIZE, b'\0')
+
+
+def save(path, id, time, duration):
+    # Written next to the old one and moved over it, so that a snapshot is
+    # never seen half written
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    count = len(id)
+    capacity = count + max(int(count * SPARE), MINIMUM_SPARE)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(encode(count, id.max() if count else 0, capacity))
+        for column, dtype, offset in zip((id, time, duration), COLUMNS, offsets(capacity)):
+            f.seek(offset)
+            np.ascontiguousarray(column, dtype=dtype).tofile(f)
+        f.truncate(HEADER_SIZE + capacity * sum(d.itemsize for d in COLUMNS))
+    os.replace(temporary, path)
+
+
+def append(path, id, time, duration):
+    # Solves that follow those of the snapshot go into the room left in
+    # its columns. The header is written last, so until then readers see
+    # the snapshot as it was. False if there is no room.
+    stored = header(path)
+    if stored is None:
+        return False
+    count, last_id, capacity = stored
+    if count + len(id) > capacity:
+        return False
+    with open(path, 'r+b') as f:
+        for column, dtype, offset in zip((id, time, duration), COLUMNS, offsets(capacity)):
+            f.seek(offset + count * dtype.itemsize)
+            np.ascontiguousarray(column, dtype=dtype).tofile(f)
+        f.flush()
+        f.seek(0)
+        f.write(encode(count + len(id), max(last_id, int(id.max())), capacity))
+    return True
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
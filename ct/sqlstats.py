@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+from math import inf, isnan
+
+import numpy as np
+
+from ct.stats import Record, Single, SortedWindow
+
+
+# The stats of a collection evaluated by SQLite, over the rows of one
+# discipline, so that only the results cross over into Python. Sums of whole
+# milliseconds are exact and are divided once, as in the NumPy path, so the
+# results are the same to the last bit.
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class TrimmedMean:
+
+    # Window function for averages dropping more than one solve at each end
+
+    def __init__(self):
+        self.window = None
+
+    def step(self, value, total, drop):
+        if self.window is None:
+            self.window = SortedWindow(total)
+            self.drop = drop
+        self.window.add(inf if value is None else float(value))
+
+    def inverse(self, value, total, drop):
+        self.window.discard(inf if value is None else float(value))
+
+    def value(self):
+        if self.window is None:
+            return None
+        result = self.window.trimmed_mean(self.drop, self.window.total - self.drop)
+        return None if isnan(result) else result
+
+    def finalize(self):
+        return self.value()
+
+
+def aggregates(stat):
+    # Window aggregates of the stat, by name, over the window of its length
+    window = f'w{stat.total}'
+    if isinstance(stat, Single):
+        return {}
+    if stat.drop == 0:
+        return {
+            f'c{stat.total}': f'count(value) OVER {window}',
+            f't{stat.total}': f'sum(value) OVER {window}',
+        }
+    if stat.drop == 1:
+        return {
+            f'c{stat.total}': f'count(value) OVER {window}',
+            f'n{stat.total}': f'count(*) OVER {window}',
+            f't{stat.total}': f'sum(value) OVER {window}',
+            f'lo{stat.total}': f'min(value) OVER {window}',
+            f'hi{stat.total}': f'max(value) OVER {window}',
+        }
+    return {
+        f'r{stat.total}_{stat.drop}': f'ct_trimmed_mean(value, {stat.total}, {stat.drop}) OVER {window}',
+    }
+
+
+def expression(stat):
+    total = stat.total
+    if isinstance(stat, Single):
+        return 'value'
+    if stat.drop == 0:
+        return f'CASE WHEN c{total} = {total} THEN CAST(t{total} AS REAL) / {total} END'
+    if stat.drop == 1:
+        # The best and worst are dropped, and a single DNF is the worst
+        return (
+            f'CASE WHEN c{total} >= {total - 1} AND n{total} > 2 THEN '
+            f'CAST(t{total} - lo{total} - CASE WHEN c{total} = n{total} THEN hi{total} ELSE 0 END AS REAL) '
+            f'/ (n{total} - 2) END'
+        )
+    return f'r{total}_{stat.drop}'
+
+
+def windows(computer, take=False):
+    # Only the last `take` solves, if asked. Each aggregate is computed once,
+    # however many stats use it.
+    columns = {}
+    for s in computer.stats:
+        columns.update(aggregates(s))
+    columns = ''.join(f', {column} AS {name}' for name, column in columns.items())
+    definitions = ', '.join(
+        f'w{total} AS (ORDER BY time, id ROWS BETWEEN {total - 1} PRECEDING AND CURRENT ROW)'
+        for total in sorted({s.total for s in computer.stats})
+    )
+    stats = ', '.join(f'{expression(s)} AS s{i}' for i, s in enumerate(computer.stats))
+    return f"""
+    WITH history AS (
+        SELECT id, time, CASE WHEN dnf THEN NULL ELSE duration END AS value
+        FROM solves
+        WHERE
+            puzzle = :puzzle AND
+            blind = :blind AND
+            one_handed = :one_handed AND
+            feet = :feet
+        {'ORDER BY time DESC, id DESC LIMIT :total' if take else ''}
+    ), aggregates AS (
+        SELECT id, time, value{columns}
+        FROM history
+        WINDOW {definitions}
+    ), windows AS MATERIALIZED (
+        SELECT id, time, {stats}
+        FROM aggregates
+    )
+    """
+
+
+def execute(connection, query, bindings):
+    connection.create_window_function('ct_trimmed_mean', 3, TrimmedMean)
+    cursor = connection.cursor()
+    try:
+        return cursor.execute(query, bindings).fetchall()
+    finally:
+        cursor.close()
+
+
+def when(time):
+    return EPOCH + timedelta(microseconds=time)
+
+
+def value(value):
+    return np.nan if value is None else float(value)
+
+
+def records(connection, computer, bindings):
+    # The earliest occurrence wins ties, like the NumPy path
+    query = windows(computer) + ' UNION ALL '.join(
+        f'SELECT * FROM (SELECT {i}, s{i}, id, time FROM windows '
+        f'WHERE s{i} IS NOT NULL ORDER BY s{i}, time, id LIMIT 1)'
+        for i in range(len(computer.stats))
+    )
+    bests = {i: (best, id, time) for i, best, id, time in execute(connection, query, bindings)}
+    return [
+        Record(s.name, when(bests[i][2]), value(bests[i][0])) if i in bests
+        else Record(s.name, None, np.nan)
+        for i, s in enumerate(computer.stats)
+    ]
+
+
+def current(connection, computer, bindings):
+    query = windows(computer, take=True) + 'SELECT * FROM windows ORDER BY time DESC, id DESC LIMIT 1'
+    rows = execute(connection, query, dict(bindings, total=computer.minimum))
+    if not rows:
+        return [Record(s.name, None, np.nan) for s in computer.stats]
+    _, time, *values = rows[0]
+    return [Record(s.name, when(time), value(v)) for s, v in zip(computer.stats, values)]
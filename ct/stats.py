@@ -1,6 +1,189 @@
-from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from math import inf, isnan
 import numpy as np
-import pandas as pd
+
+from ct.util import lazy_import
+
+pd = lazy_import('pandas')
+
+
+Record = namedtuple('Record', ['name', 'when', 'duration'])
+
+
+class Windows:
+
+    # What the stats of one collection share over the same values: prefix
+    # sums and DNF counts, and minima of runs whose length is a power of two,
+    # from which the extremes of any window are two lookups. Only the powers
+    # needed for the given window lengths are kept.
+
+    def __init__(self, values, totals=()):
+        self.values = values
+        finite = ~np.isnan(values)
+        self.sums = np.concatenate([[0.0], np.cumsum(np.where(finite, values, 0.0))])
+        self.counts = np.concatenate([[0], np.cumsum(finite)])
+
+        needed = set()
+        for total in totals:
+            needed.update(int(length).bit_length() - 1 for length in (total - 1, total) if length > 0)
+        self.low, self.high = {}, {}
+        low = high = np.where(finite, values, inf)
+        for k in range(max(needed, default=-1) + 1):
+            if k:
+                step = 1 << (k - 1)
+                low = np.minimum(low[:-step], low[step:])
+                high = np.maximum(high[:-step], high[step:])
+            if k in needed:
+                self.low[k], self.high[k] = low, high
+
+    def bounds(self, total):
+        # Trailing windows, truncated at the start just like pandas' rolling
+        # windows
+        hi = np.arange(1, len(self.values) + 1)
+        lo = np.maximum(hi - total, 0)
+        return lo, hi
+
+    def window_sums(self, total):
+        # Durations are whole milliseconds, so the prefix sums are exact
+        lo, hi = self.bounds(total)
+        return self.sums[hi] - self.sums[lo], self.counts[hi] - self.counts[lo]
+
+    def extremes(self, total):
+        # Minimum and maximum of each window at least total - 1 long, DNFs
+        # counting as infinite
+        lo, hi = self.bounds(total)
+        low = np.full(len(hi), np.nan)
+        high = np.full(len(hi), np.nan)
+        for length in {total - 1, total}:
+            if length <= 0:
+                continue
+            k = length.bit_length() - 1
+            i = np.flatnonzero(hi - lo == length)
+            low[i] = np.minimum(self.low[k][lo[i]], self.low[k][hi[i] - (1 << k)])
+            high[i] = np.maximum(self.high[k][lo[i]], self.high[k][hi[i] - (1 << k)])
+        return low, high
+
+
+class SortedWindow:
+
+    def __init__(self, total):
+        self.total = total
+        self.queue = deque()
+        self.sorted = []
+        self.sum = 0.0
+
+    def push(self, value):
+        value = inf if isnan(value) else float(value)
+        if len(self.queue) == self.total:
+            self.discard(self.queue.popleft())
+        self.queue.append(value)
+        self.add(value)
+
+    def add(self, value):
+        insort(self.sorted, value)
+        if value != inf:
+            self.sum += value
+
+    def discard(self, value):
+        del self.sorted[bisect_left(self.sorted, value)]
+        if value != inf:
+            self.sum -= value
+
+    @property
+    def count(self):
+        return bisect_left(self.sorted, inf)
+
+    def trimmed_mean(self, drop, minimum):
+        # DNFs sort last, so they are the first to be dropped
+        count = self.count
+        if count < minimum:
+            return np.nan
+        length = len(self.sorted)
+        if length <= 2 * drop:
+            return np.nan
+        total = self.sum - sum(self.sorted[:drop]) - sum(self.sorted[length-drop:count])
+        return total / (length - 2 * drop)
+
+
+# Values kept at once while finding the smallest of windows, and what a DNF
+# counts as there: more than any duration, and exact in sums
+CHUNK = 1 << 22
+DNF = 2.0 ** 40
+
+
+def smallest_sums(values, total, count):
+    # Sums of the `count` smallest values of each window of `total`, by the
+    # position the window ends at, for the full ones. The values are cut into
+    # blocks of `total`, so that a window is the end of one block and the
+    # start of the next, like sliding minima are found by van Herk, Gil and
+    # Werman. The smallest of each part are kept sorted, one offset into the
+    # blocks at a time for all of them, and those of the window are the best
+    # split of `count` between the two parts.
+    blocks = -(-len(values) // total)
+    padded = np.full(blocks * total, inf)
+    padded[:len(values)] = values
+    # By offset into the blocks, so that each offset is read in one go
+    offsets = np.ascontiguousarray(padded.reshape(blocks, total).T)
+    result = np.full((total, blocks), inf)
+    group = max(1, CHUNK // (total * (count + 1)))
+    for lo in range(0, blocks, group):
+        hi = min(lo + group, blocks)
+        previous = np.full((total, hi - lo), inf)
+        previous[:, int(lo == 0):] = offsets[:, max(lo - 1, 0):hi-1]
+
+        smallest = sorted_rows(count, hi - lo)
+        suffixes = np.empty((total + 1, count + 1, hi - lo))
+        suffixes[total] = smallest
+        for t in range(total - 1, -1, -1):
+            insert(smallest, previous[t])
+            suffixes[t] = smallest
+        suffixes[:, 0] = 0.0
+        np.cumsum(suffixes, axis=1, out=suffixes)
+
+        smallest = sorted_rows(count, hi - lo)
+        for t in range(total):
+            insert(smallest, offsets[t, lo:hi])
+            prefixes = np.cumsum(smallest[1:], axis=0)
+            splits = (suffixes[t+1][:count] + prefixes[::-1]).min(axis=0)
+            result[t, lo:hi] = np.minimum(splits, suffixes[t+1][count])
+    return result.T.ravel()[:len(values)]
+
+
+def sorted_rows(count, blocks):
+    # The smallest values taken in for each block, sorted down the rows,
+    # after a row of -inf
+    smallest = np.full((count + 1, blocks), inf)
+    smallest[0] = -inf
+    return smallest
+
+
+def insert(smallest, values):
+    # Each block takes in one more value
+    np.minimum(smallest[1:], np.maximum(smallest[:-1], values), out=smallest[1:])
+
+
+def trimmed_means(windows, total, drop):
+    # Means of the windows without their `drop` best and worst, DNFs sorting
+    # last, just like SortedWindow. Those with more DNFs than are dropped
+    # have none. The few truncated windows that count are sorted one by one.
+    values = np.where(np.isnan(windows.values), DNF, windows.values)
+    sums, counts = windows.window_sums(total)
+    lo, hi = windows.bounds(total)
+    lengths = hi - lo
+    result = np.full(len(values), np.nan)
+    valid = (counts >= total - drop) & (lengths > 2 * drop)
+
+    full = np.flatnonzero(valid & (lengths == total))
+    if len(full):
+        low = smallest_sums(values, total, drop)
+        high = -smallest_sums(-values, total, drop) - (lengths - counts) * DNF
+        result[full] = (sums[full] - low[full] - high[full]) / (total - 2 * drop)
+    for i in np.flatnonzero(valid & (lengths < total)):
+        window = np.sort(values[lo[i]:hi[i]])
+        result[i] = window[drop:lengths[i]-drop].mean()
+    return result
 
 
 class Average:
@@ -11,30 +194,67 @@ class Average:
         self.drop = drop
         self.minimum = total
 
+    def rolling(self, values):
+        return self.evaluate(Windows(values, [self.total]))
+
+    def evaluate(self, windows):
+        sums, counts = windows.window_sums(self.total)
+        result = np.full(len(sums), np.nan)
+        if self.drop == 0:
+            full = counts == self.total
+            result[full] = sums[full] / self.total
+        elif self.drop == 1:
+            # The best and worst are dropped, and a single DNF is the worst
+            lo, hi = windows.bounds(self.total)
+            lengths = hi - lo
+            low, high = windows.extremes(self.total)
+            valid = (counts >= self.total - 1) & (lengths > 2)
+            dropped = low + np.where(counts == lengths, high, 0.0)
+            result[valid] = (sums[valid] - dropped[valid]) / (lengths[valid] - 2)
+        else:
+            result = trimmed_means(windows, self.total, self.drop)
+        return result
+
     def compute(self, data):
-        s = slice(self.drop, -self.drop if self.drop else None)
-        def operator(d):
-            return np.sort(d)[s].mean()
-        return data.rolling(window=self.total, min_periods=self.total-self.drop).apply(operator)
+        values = data.to_numpy(dtype=float)
+        return pd.Series(data=self.rolling(values), index=data.index)
 
 
 class Single:
 
     def __init__(self):
         self.name = 'Single'
+        self.total = 1
         self.minimum = 1
 
+    def rolling(self, values):
+        return values
+
+    def evaluate(self, windows):
+        return windows.values
+
     def compute(self, data):
         return data
 
 
 class StatsCollection:
 
+    # All stats are evaluated over one shared Windows, so another average
+    # costs a few vectorised passes rather than a pass of its own
+
     def __init__(self, *args):
         self.stats = args
 
+    def rolling(self, values):
+        windows = Windows(values, [s.total for s in self.stats if getattr(s, 'drop', None) == 1])
+        return OrderedDict([(s.name, s.evaluate(windows)) for s in self.stats])
+
     def compute(self, data):
-        data = OrderedDict([(s.name, s.compute(data)) for s in self.stats])
+        values = data.to_numpy(dtype=float)
+        data = OrderedDict([
+            (name, pd.Series(data=column, index=data.index))
+            for name, column in self.rolling(values).items()
+        ])
         return pd.DataFrame(data=data)
 
     @property
@@ -42,9 +262,239 @@ class StatsCollection:
         return max(s.minimum for s in self.stats)
 
 
-default_stats = StatsCollection(
-    Single(),
-    Average('Avg. of 5', 5, 1),
-    Average('Avg. of 12', 12, 1),
-    Average('Mean of 100', 100, 0),
-)
+def trim(total):
+    # Solves dropped at each end of an average of `total`: 5%, rounded up,
+    # as csTimer does, so one for up to 20
+    return -(-total // 20)
+
+
+def parse(name):
+    # 'single', 'aoN' (dropping 5% of N, rounded up, at each end) or 'moN'
+    # (the mean of N)
+    name = name.strip().lower()
+    if name == 'single':
+        return Single()
+    if name[:2] in ('ao', 'mo') and name[2:].isdigit() and int(name[2:]) > 0:
+        total = int(name[2:])
+        if name.startswith('ao'):
+            return Average(f'Avg. of {total}', total, trim(total))
+        return Average(f'Mean of {total}', total, 0)
+    raise ValueError(f'unknown statistic: {name!r}')
+
+
+@lru_cache()
+def collection(names):
+    return StatsCollection(*(parse(name) for name in names))
+
+
+def best(values, whens, ids):
+    # The earliest occurrence wins ties, like Series.argmin
+    if not np.isfinite(values).any():
+        return (np.nan, None, None)
+    i = int(np.nanargmin(values))
+    return (values[i], whens[i], ids[i])
+
+
+class Blocks:
+
+    # The bests of each stat over blocks of consecutive window positions, so
+    # that a change has only the blocks around it evaluated again, and a best
+    # it displaced is found among those of the other blocks. A block starts
+    # at the time of its first solve, which stays put when solves are added
+    # or removed elsewhere, and solves of the same time are never split.
+    # The columns are a cache.Columns; `version` is the one of theirs that
+    # the blocks are in step with.
+
+    SIZE = 4096
+
+    def __init__(self, computer, columns):
+        self.computer = computer
+        self.span = computer.minimum
+        self.starts, self.sizes, self.minima = [], [], []
+        ids, times, values = columns.view()
+        rolling = list(computer.rolling(values).values())
+        lo = 0
+        while lo < len(ids):
+            hi = int(np.searchsorted(times, times[min(lo + self.SIZE, len(ids)) - 1], 'right'))
+            self.starts.append(times[lo])
+            self.sizes.append(hi - lo)
+            self.minima.append([earliest(column[lo:hi], times[lo:hi], ids[lo:hi]) for column in rolling])
+            lo = hi
+        self.version = columns.version
+
+    def block(self, time):
+        return max(bisect_right(self.starts, np.datetime64(time, 'us')) - 1, 0)
+
+    def evaluate(self, columns, k):
+        lo = columns.bound(self.starts[k]) if k else 0
+        hi = columns.bound(self.starts[k+1]) if k + 1 < len(self.starts) else columns.length
+        start = columns.back(lo, self.span - 1)
+        context = len(columns.live(start, lo)[0])
+        ids, times, values = columns.live(start, hi)
+        rolling = self.computer.rolling(values)
+        self.sizes[k] = len(ids) - context
+        self.minima[k] = [
+            earliest(column[context:], times[context:], ids[context:]) for column in rolling.values()
+        ]
+
+    def refresh(self, columns, time):
+        # After a change to a solve timed at the given time: the windows that
+        # may hold it end among the solves of that time and the `span - 1`
+        # after them
+        time = np.datetime64(time, 'us')
+        if not self.starts:
+            self.starts, self.sizes, self.minima = [time], [0], [None]
+        end = columns.forward(columns.bound(time + np.timedelta64(1, 'us')), self.span - 1)
+        last = columns.time[end-1] if end else time
+        for k in range(self.block(time), self.block(max(time, last)) + 1):
+            self.evaluate(columns, k)
+        self.version = columns.version
+
+    def push(self, columns, id, when, values):
+        # After a solve was added, with the values of the windows it ends. If
+        # it was not added last, its blocks are evaluated again.
+        n = columns.length
+        time = np.datetime64(when, 'us')
+        if not n or columns.id[n-1] != id or not self.starts:
+            return self.refresh(columns, time)
+        if self.sizes[-1] >= self.SIZE and n > 1 and columns.time[n-2] < time:
+            self.starts.append(time)
+            self.sizes.append(0)
+            self.minima.append([(np.nan, None, None)] * len(values))
+        minima = self.minima[-1]
+        for i, value in enumerate(values):
+            if not isnan(value) and (isnan(minima[i][0]) or value < minima[i][0]):
+                minima[i] = (value, when, id)
+        self.sizes[-1] += 1
+        self.version = columns.version
+
+    def bests(self):
+        # Blocks are in order, so the earliest best wins ties
+        bests = OrderedDict()
+        for i, s in enumerate(self.computer.stats):
+            bests[s.name] = (np.nan, None, None)
+            for minima in self.minima:
+                value = minima[i][0]
+                if not isnan(value) and (isnan(bests[s.name][0]) or value < bests[s.name][0]):
+                    bests[s.name] = minima[i]
+        return bests
+
+
+def earliest(values, times, ids):
+    # The best of a block, with the time as a datetime like the state has
+    value, time, id = best(values, times, ids)
+    return (value, None if time is None else time.item(), id)
+
+
+class StatsState:
+
+    # Incremental statistics for one discipline. Only the last `span` window
+    # positions (the tail) are kept live, together with the `span - 1` solves
+    # preceding them. Everything older is folded into the frozen bests, so a
+    # new solve, or an edit within the tail, costs O(span) to take in.
+    #
+    # If `bests` is given, they are taken as the bests over the whole history
+    # and the solves need only be its last `2 * span - 1`.
+
+    def __init__(self, computer, values, whens, ids, bests=None):
+        self.computer = computer
+        self.span = computer.minimum
+        start = max(0, len(values) - self.span)
+        context = max(0, start - self.span + 1)
+
+        if bests is None:
+            bests = OrderedDict(
+                (name, best(column[:start], whens, ids))
+                for name, column in computer.rolling(values).items()
+            )
+        self.frozen = bests
+        self.entries = list(zip(ids[context:], whens[context:], values[context:]))
+        self.start = start - context
+        self.refresh()
+
+    def refresh(self):
+        values = np.array([value for _, _, value in self.entries], dtype=float)
+        whens = [when for _, when, _ in self.entries[self.start:]]
+        ids = [id for id, _, _ in self.entries[self.start:]]
+
+        self.values = self.computer.rolling(values)
+        self.bests = OrderedDict()
+        for name, column in self.values.items():
+            frozen = self.frozen[name]
+            tail = best(column[self.start:], whens, ids)
+            if isnan(frozen[0]) or tail[0] < frozen[0]:
+                frozen = tail
+            self.bests[name] = frozen
+
+    def fold(self):
+        for name, column in self.values.items():
+            value = column[self.start]
+            if isnan(self.frozen[name][0]) or value < self.frozen[name][0]:
+                id, when, _ = self.entries[self.start]
+                self.frozen[name] = (value, when, id)
+        self.start += 1
+        if self.start >= self.span:
+            del self.entries[0]
+            self.start -= 1
+
+    def index(self, id):
+        # Edits are only safe within the tail, and only if no frozen best
+        # was set there
+        tail = [other for other, _, _ in self.entries[self.start:]]
+        if id not in tail or any(best[2] in tail for best in self.frozen.values()):
+            return None
+        return self.start + tail.index(id)
+
+    def follows(self, when, id):
+        # If a solve comes after all of the state's, by time and then id
+        if not self.entries:
+            return True
+        last, last_when, _ = self.entries[-1]
+        return (when, id) > (last_when, last)
+
+    def __contains__(self, id):
+        return any(id == other for other, _, _ in self.entries)
+
+    @property
+    def records(self):
+        return [Record(name, when, value) for name, (value, when, _) in self.bests.items()]
+
+    @property
+    def current(self):
+        when = self.entries[-1][1] if self.entries else None
+        return [
+            Record(name, when, column[-1] if len(column) else np.nan)
+            for name, column in self.values.items()
+        ]
+
+    def push(self, id, when, value):
+        previous = self.records
+        if len(self.entries) - self.start >= self.span:
+            self.fold()
+        self.entries.append((id, when, value))
+        self.refresh()
+        return [
+            cur for rec, cur in zip(previous, self.current)
+            if cur.duration < rec.duration
+        ]
+
+    def update(self, id, value):
+        i = self.index(id)
+        if i is None:
+            return False
+        id, when, _ = self.entries[i]
+        self.entries[i] = (id, when, value)
+        self.refresh()
+        return True
+
+    def remove(self, id):
+        i = self.index(id)
+        if i is None:
+            return False
+        del self.entries[i]
+        self.refresh()
+        return True
+
+
+DEFAULT_STATS = ('single', 'ao5', 'ao12', 'mo100')
+default_stats = collection(DEFAULT_STATS)
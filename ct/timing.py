@@ -1,7 +1,13 @@
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QGuiApplication
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
+from time import perf_counter_ns
+import sys
 
-from ct.db import Discipline
+from ct import persist
+from ct.discipline import Discipline
+from ct.util import EventHandler
 
 
 class State(Enum):
@@ -9,26 +15,57 @@ class State(Enum):
     solving = auto()
 
 
-class EventHandler:
+class Relay(QObject):
+
+    posted = pyqtSignal(object, object)
 
     def __init__(self):
-        self.handlers = []
+        super(Relay, self).__init__()
+        self.posted.connect(self.call)
+
+    @pyqtSlot(object, object)
+    def call(self, handler, args):
+        handler(*args)
+
 
-    def register(self, handler):
-        self.handlers.append(handler)
+# Events raised on other threads are delivered on the Qt thread
+_relay = Relay()
+
+
+def post(handler, *args):
+    _relay.posted.emit(handler, args)
 
-    def __call__(self, *args, **kwargs):
-        for handler in self.handlers:
-            handler(*args, **kwargs)
 
 discipline_changed = EventHandler()
 scramble_changed = EventHandler()
 clock_changed = EventHandler()
 state_changed = EventHandler()
 new_solve = EventHandler()
+stats_changed = EventHandler()
+history_changed = EventHandler()
+persist_failed = EventHandler()
+
+persist.failed.register(lambda error, operations: post(persist_failed, error, operations))
+
+# The clock display is refreshed once per frame of the screen, or rarely
+# when the window is hidden. Solve times never depend on this: they come
+# from the timestamps taken when the solve starts and stops.
+DEFAULT_REFRESH_INTERVAL = 16
+HIDDEN_REFRESH_INTERVAL = 1000
 
 state = State.waiting
 clock = None
+visible = True
+
+_started = None
+_refresh = None
+
+# Statistics are computed by a single worker thread, so jobs run in order
+# and a discipline's state is only touched by one thread. A new request of
+# a kind cancels the previous one if it has not started, and results that
+# are superseded or belong to another discipline are dropped.
+_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ct-stats')
+_requests = {}
 
 discipline = Discipline('3')
 scramble = discipline.scramble()
@@ -37,47 +74,168 @@ scramble = discipline.scramble()
 def set_discipline(_discipline):
     assert state == State.waiting
     global discipline, clock, scramble
+    for future in _requests.values():
+        future.cancel()
+    _requests.clear()
     discipline = _discipline
     scramble = discipline.scramble()
     clock = None
     discipline_changed()
     scramble_changed()
     clock_changed()
+    request_stats()
+
+
+def _submit(event, func, *args, kind=None):
+    if kind in _requests:
+        _requests[kind].cancel()
+    future = _worker.submit(func, *args)
+    if kind is not None:
+        _requests[kind] = future
+    target = discipline
+    future.add_done_callback(lambda future: post(_deliver, future, target, event, kind))
+
+
+def _deliver(future, target, event, kind):
+    if future.cancelled():
+        return
+    try:
+        result = future.result()
+    except Exception as error:
+        # Raising in a slot would abort the application. What the job
+        # changed may not have been written, and the state it left is read
+        # again from the database.
+        if _requests.get(kind) is future:
+            del _requests[kind]
+        _worker.submit(target.forget)
+        persist_failed(error, ())
+        return
+    if kind is not None:
+        if _requests.get(kind) is not future:
+            return
+        del _requests[kind]
+    if event is not None and target is discipline:
+        event(*result)
+
+
+def _stats(target, solve=None, new_records=()):
+    return solve, list(target.records()), list(target.current()), list(new_records)
+
+
+def _push(target, solve):
+    return _stats(target, solve, target.push(solve))
+
+
+def _update(target, solve):
+    target.save(solve)
+    return _stats(target)
+
+
+def _remove(target, solve):
+    target.delete(solve)
+    return _stats(target)
+
+
+def _history(target):
+    return (target.historical(),) + _stats(target)[1:3]
+
+
+def request_stats():
+    _submit(stats_changed, _stats, discipline, kind='stats')
+
+
+def request_history():
+    _submit(history_changed, _history, discipline, kind='history')
+
+
+def save(solve):
+    _submit(stats_changed, _update, discipline, solve)
+
+
+def delete(solve):
+    _submit(stats_changed, _remove, discipline, solve)
+
+
+def read(handler, func, *args):
+    # Reads the database on the worker, where the changes submitted before
+    # have been queued for writing, and hands the result to the Qt thread.
+    # A read that fails is only reported, as it changed nothing.
+    target = discipline
+    future = _worker.submit(func, *args)
+    future.add_done_callback(lambda future: post(_read, future, target, handler))
+
+
+def _read(future, target, handler):
+    error = future.exception()
+    if error is not None:
+        print(f'ct: could not read the database: {error}', file=sys.stderr)
+    elif target is discipline:
+        handler(future.result())
+
+
+def refresh_interval():
+    if not visible:
+        return HIDDEN_REFRESH_INTERVAL
+    screen = QGuiApplication.primaryScreen()
+    if screen is None or screen.refreshRate() <= 0:
+        return DEFAULT_REFRESH_INTERVAL
+    return max(1, int(1000 / screen.refreshRate()))
+
+
+def set_visible(_visible):
+    global visible
+    visible = _visible
+    if state == State.solving:
+        _refresh.setInterval(refresh_interval())
+
+
+def elapsed():
+    return (perf_counter_ns() - _started) // 1000000
 
 
 def _start_solving():
-    global state, clock
+    global state, clock, _started, _refresh
+    _started = perf_counter_ns()
     state = State.solving
     state_changed()
     clock = 0
     clock_changed()
 
-    timer = QTimer()
-    timer.timeout.connect(lambda: _solving_timeout(timer))
-    timer.start(10)
+    if _refresh is None:
+        _refresh = QTimer()
+        _refresh.setTimerType(Qt.CoarseTimer)
+        _refresh.timeout.connect(_solving_timeout)
+    _refresh.start(refresh_interval())
 
 
-def _solving_timeout(timer):
-    global state, clock
-    if state != State.solving:
-        timer.stop()
-        return
-    clock += 10
+def _solving_timeout():
+    global clock
+    clock = elapsed()
     clock_changed()
 
 
 def _finish_solving():
-    global state, scramble
+    global state, clock, scramble
+    clock = elapsed()
+    _refresh.stop()
     state = State.waiting
     state_changed()
-    solve, records = discipline.append(clock, scramble=scramble)
+    clock_changed()
+    solve = discipline.add(clock, scramble=scramble)
     scramble = discipline.scramble()
     scramble_changed()
-    new_solve(solve, records)
+    new_solve(solve)
+
+    # The statistics of the new solve supersede any that were requested
+    if 'stats' in _requests:
+        _requests.pop('stats').cancel()
+    _submit(stats_changed, _push, discipline, solve)
 
 
 def escape():
     global state, clock, scramble
+    if _refresh is not None:
+        _refresh.stop()
     state = State.waiting
     state_changed()
     clock = None
@@ -0,0 +1,416 @@
+from collections import OrderedDict
+from datetime import date, datetime
+from math import isnan
+import csv
+import json
+import re
+import sys
+
+from sqlalchemy import select
+
+from ct import db
+
+
+FIELDS = ['time', 'duration', 'plus_two', 'dnf', 'scramble', 'remarks']
+
+# Columns of a full export, followed by those of the stats
+EXPORT_FIELDS = ['id'] + FIELDS
+
+# Rows per insert statement when importing, and per chunk when exporting
+CHUNK_SIZE = 10000
+
+
+def export_chunks(discipline, start=None, end=None, stats=True):
+    # The solves between two dates, end excluded, as columns a chunk at a
+    # time, with the rolling stats of the discipline. The windows of the
+    # first solves in a chunk reach back into the solves before it, so the
+    # values of those are carried along.
+    import numpy as np
+
+    start, end = (
+        datetime(t.year, t.month, t.day) if type(t) is date else t
+        for t in (start, end)
+    )
+    computer = discipline.stats_computer
+    names = [s.name for s in computer.stats if s.total > 1] if stats else []
+    context = np.empty(0)
+
+    table = db.Solve.__table__
+    if names and start is not None:
+        query = select([table.c.duration, table.c.dnf])
+        query = query.where(discipline.condition(table)).where(table.c.time < start)
+        query = query.order_by(table.c.time.desc(), table.c.id.desc()).limit(computer.minimum - 1)
+        db.writer.wait()
+        rows = db.engine.execute(query).fetchall()[::-1]
+        context = np.array([np.nan if dnf else duration for duration, dnf in rows], dtype=float)
+
+    query = table.select().where(discipline.condition(table))
+    if start is not None:
+        query = query.where(table.c.time >= start)
+    if end is not None:
+        query = query.where(table.c.time < end)
+    query = query.order_by(table.c.time, table.c.id)
+
+    # SQLite steps through the rows as they are fetched, so only a chunk is
+    # held at a time
+    db.writer.wait()
+    with db.engine.connect() as conn:
+        result = conn.execute(query)
+        while True:
+            rows = result.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            columns = OrderedDict((field, [row[field] for row in rows]) for field in EXPORT_FIELDS)
+            if names:
+                values = np.array([
+                    np.nan if dnf else duration
+                    for duration, dnf in zip(columns['duration'], columns['dnf'])
+                ], dtype=float)
+                values = np.concatenate([context, values])
+                rolling = computer.rolling(values)
+                for name in names:
+                    columns[name] = rolling[name][len(context):]
+                context = values[max(len(values) - computer.minimum + 1, 0):]
+            yield columns
+
+
+def export_csv(discipline, f, start=None, end=None, stats=True):
+    write_csv(export_chunks(discipline, start, end, stats), f)
+
+
+def write_csv(chunks, f):
+    writer = csv.writer(f)
+    header = False
+    for columns in chunks:
+        if not header:
+            writer.writerow(columns)
+            header = True
+        for row in zip(*columns.values()):
+            writer.writerow([csv_value(value) for value in row])
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float):
+        return '' if isnan(value) else value
+    return value
+
+
+def write_arrow(chunks, path, parquet=True):
+    # Parquet, or else the Arrow IPC file format, written a record batch at a
+    # time
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('exporting to Parquet or Arrow needs pyarrow') from None
+    import numpy as np
+
+    types = {
+        'id': pa.int64(),
+        'time': pa.timestamp('us'),
+        'duration': pa.int64(),
+        'plus_two': pa.bool_(),
+        'dnf': pa.bool_(),
+        'scramble': pa.string(),
+        'remarks': pa.string(),
+    }
+    writer = None
+    try:
+        for columns in chunks:
+            arrays = OrderedDict()
+            for name, column in columns.items():
+                if name in types:
+                    arrays[name] = pa.array(column, type=types[name])
+                else:
+                    arrays[name] = pa.array(column, mask=np.isnan(column))
+            batch = pa.RecordBatch.from_arrays(list(arrays.values()), names=list(arrays))
+            if writer is None:
+                if parquet:
+                    writer = pq.ParquetWriter(path, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(path, batch.schema)
+            if parquet:
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def export(discipline, path, format='csv', start=None, end=None, stats=True):
+    # Writes to standard output for a path of -
+    if format in ('parquet', 'arrow'):
+        chunks = export_chunks(discipline, start, end, stats)
+        return write_arrow(chunks, path, parquet=format == 'parquet')
+    if path == '-':
+        return export_csv(discipline, sys.stdout, start, end, stats)
+    with open(path, 'w', newline='') as f:
+        export_csv(discipline, f, start, end, stats)
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield {
+            'time': datetime.fromisoformat(row['time']),
+            'duration': int(row['duration']),
+            'plus_two': bool(int(row.get('plus_two') or 0)),
+            'dnf': bool(int(row.get('dnf') or 0)),
+            'scramble': row.get('scramble') or None,
+            'remarks': row.get('remarks') or None,
+        }
+
+
+class Importer:
+
+    # Solves are inserted in large batches of plain tuples, at most a few of
+    # them queued at a time, and the records and summaries of every
+    # discipline touched are rebuilt once at the end. The solves of csTimer
+    # sessions with no discipline here are left out, counted by type.
+
+    MAX_PENDING = 2
+
+    def __init__(self):
+        self.time = db.UnixTime()
+        self.chunk = []
+        self.blocks = []
+        self.ids = iter(())
+        self.touched = set()
+        self.total = 0
+        self.skipped = OrderedDict()
+
+    def add(self, discipline, solve):
+        id = next(self.ids, None)
+        if id is None:
+            self.blocks.append(db.reserve(CHUNK_SIZE))
+            self.ids = iter(self.blocks[-1])
+            id = next(self.ids)
+        self.chunk.append((
+            id, self.time.process_bind_param(solve['time'], None), solve['duration'],
+            *discipline, solve['plus_two'], solve['dnf'], solve['scramble'], solve['remarks'],
+        ))
+        self.touched.add(discipline)
+        if len(self.chunk) == CHUNK_SIZE:
+            self.flush()
+        return id
+
+    def flush(self):
+        if self.chunk:
+            db.writer.submit(
+                'INSERT INTO solves (id, time, duration, puzzle, blind, one_handed, feet, '
+                'plus_two, dnf, scramble, remarks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                self.chunk,
+            )
+            self.total += len(self.chunk)
+            self.chunk = []
+        if db.writer.pending > self.MAX_PENDING:
+            db.writer.wait()
+
+    def ranges(self, first, last):
+        # The ids from first to last that were added here. Ids are reserved a
+        # chunk at a time, and other writers may have taken those between.
+        self.flush()
+        for block in self.blocks:
+            lo, hi = max(first, block[0]), min(last, block[-1])
+            if lo <= hi:
+                yield lo, hi
+
+    def move(self, first, last, discipline):
+        # Solves already added with ids from first to last belong to another
+        # discipline
+        for lo, hi in self.ranges(first, last):
+            db.writer.submit(
+                'UPDATE solves SET puzzle = ?, blind = ?, one_handed = ?, feet = ? '
+                'WHERE id BETWEEN ? AND ?',
+                (*discipline, lo, hi),
+            )
+        self.touched.add(discipline)
+
+    def skip(self, first, last, kind):
+        for lo, hi in self.ranges(first, last):
+            db.writer.submit('DELETE FROM solves WHERE id BETWEEN ? AND ?', (lo, hi))
+            self.total -= hi - lo + 1
+            self.skipped[kind] = self.skipped.get(kind, 0) + hi - lo + 1
+
+    def finish(self):
+        # The number of solves imported, and of those skipped by type
+        from ct.discipline import Discipline
+        self.flush()
+        for discipline in self.touched:
+            Discipline(*discipline).reindex()
+        return self.total, self.skipped
+
+
+def import_solves(discipline, solves):
+    importer = Importer()
+    for solve in solves:
+        importer.add(discipline.key, solve)
+    return importer.finish()
+
+
+# Disciplines of csTimer's scramble types
+CSTIMER_TYPES = {
+    '222so': ('2', False, False, False),
+    '333': ('3', False, False, False),
+    '444wca': ('4', False, False, False),
+    '555wca': ('5', False, False, False),
+    '333ni': ('3', True, False, False),
+    '444bld': ('4', True, False, False),
+    '555bld': ('5', True, False, False),
+    '333oh': ('3', False, True, False),
+    '333ft': ('3', False, False, True),
+}
+
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+CSTIMER_TIME = re.compile(r'(DNF\()?(?:(\d+):)?(\d+(?:\.\d+)?)\)?(\+)?')
+
+
+class JSONReader:
+
+    # Reads JSON values one at a time, so that a file can be walked through
+    # without loading it whole
+
+    def __init__(self, f, size=1 << 16):
+        self.f = f
+        self.size = size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(self.size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos+1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} in JSON, found {self.peek()!r}')
+        self.pos += 1
+
+    def skip(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def value(self):
+        if self.pos == len(self.buffer) or self.buffer[self.pos] in ' \t\r\n':
+            self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the very end may have been cut short
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        # Key and value pairs of an object, or of its arrays element by
+        # element, with None after the last element of each array
+        self.expect('{')
+        while not self.skip('}'):
+            key = self.value()
+            self.expect(':')
+            if self.skip('['):
+                while not self.skip(']'):
+                    yield key, self.value()
+                    self.skip(',')
+                yield key, None
+            else:
+                yield key, self.value()
+            self.skip(',')
+
+
+def cstimer_solve(item):
+    (penalty, time), scramble, remarks, timestamp = item[:4]
+    return {
+        'time': datetime.utcfromtimestamp(timestamp),
+        'duration': time + max(penalty, 0),
+        'plus_two': penalty > 0,
+        'dnf': penalty < 0,
+        'scramble': scramble or None,
+        'remarks': remarks or None,
+    }
+
+
+def import_cstimer_json(discipline, f):
+    # The sessions are imported into the given discipline as they are read,
+    # and moved to their own once the session data is found, which may come
+    # after them
+    importer = Importer()
+    ranges = {}
+    sessions = {}
+    first = last = None
+    for name, item in JSONReader(f).items():
+        if name == 'properties':
+            sessions = json.loads(item.get('sessionData') or '{}')
+        elif not name.startswith('session'):
+            continue
+        elif item is None:
+            if first is not None:
+                ranges[name[len('session'):]] = (first, last)
+            first = None
+        else:
+            last = importer.add(discipline.key, cstimer_solve(item))
+            if first is None:
+                first = last
+
+    for session, (first, last) in ranges.items():
+        options = sessions.get(session, {}).get('opt', {})
+        kind = options.get('scrType', '333')
+        target = CSTIMER_TYPES.get(kind)
+        if target is None:
+            importer.skip(first, last, kind)
+        elif target != discipline.key:
+            importer.move(first, last, target)
+    return importer.finish()
+
+
+def read_cstimer_csv(f):
+    for row in csv.DictReader(f, delimiter=';'):
+        match = CSTIMER_TIME.fullmatch(row['Time'].strip())
+        if match is None:
+            continue
+        dnf, minutes, seconds, plus_two = match.groups()
+        yield {
+            'time': datetime.fromisoformat(row['Date']),
+            'duration': round((int(minutes or 0) * 60 + float(seconds)) * 1000),
+            'plus_two': bool(plus_two),
+            'dnf': bool(dnf),
+            'scramble': row.get('Scramble') or None,
+            'remarks': row.get('Comment') or None,
+        }
+
+
+def import_file(discipline, path):
+    # By content: csTimer's JSON export, csTimer's CSV export of a session,
+    # or the CSV written by export_csv
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        start = f.read(1)
+        f.seek(0)
+        if start == '{':
+            return import_cstimer_json(discipline, f)
+        header = f.readline()
+        f.seek(0)
+        if ';' in header:
+            return import_solves(discipline, read_cstimer_csv(f))
+        return import_solves(discipline, read_csv(f))
@@ -1,4 +1,6 @@
+from importlib import import_module
 from math import isnan
+import sys
 
 
 def format_time(time):
@@ -10,3 +12,41 @@ def format_time(time):
     if mins > 0:
         return f'{mins}:{sec:02}.{csec:02}'
     return f'{sec}.{csec:02}'
+
+
+class LazyModule:
+
+    # Imports the module on first attribute access. Unlike LazyLoader, this
+    # goes through the regular import machinery, so it is safe when several
+    # threads get there at once.
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+class EventHandler:
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, handler):
+        self.handlers.append(handler)
+
+    def unregister(self, handler):
+        self.handlers.remove(handler)
+
+    def __call__(self, *args, **kwargs):
+        for handler in self.handlers:
+            handler(*args, **kwargs)
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+import random
+
+import numpy as np
+
+from ct.cache import Columns
+
+
+START = datetime(2020, 1, 1)
+
+
+def test_columns(monkeypatch):
+    # Against a sorted list, with the arrays read-only as if mapped from a
+    # snapshot, and compacted after a few removals
+    monkeypatch.setattr(Columns, 'COMPACT', 8)
+    rng = random.Random(0)
+    solves = [(START + timedelta(seconds=i // 2), i, float(i)) for i in range(1, 200)]
+    columns = [
+        np.array([id for _, id, _ in solves]),
+        np.array([time for time, _, _ in solves], dtype='datetime64[us]'),
+        np.array([duration for _, _, duration in solves]),
+    ]
+    for column in columns:
+        column.flags.writeable = False
+    columns = Columns(*columns)
+    removed = []
+
+    for id in range(200, 1200):
+        op = rng.random()
+        if op < 0.3:
+            time = rng.choice(solves)[0] + timedelta(microseconds=rng.randint(0, 1))
+            solves.append((time, id, float(id)))
+            columns.insert(id, time, float(id))
+        elif op < 0.4 and removed:
+            # Brought back, as when a removal is rolled back
+            time, other, duration = removed.pop(rng.randrange(len(removed)))
+            solves.append((time, other, duration))
+            columns.insert(other, time, duration)
+        elif op < 0.7:
+            i = rng.randrange(len(solves))
+            time, other, _ = solves[i]
+            solves[i] = (time, other, float(id))
+            columns.update(other, time, float(id))
+        else:
+            solve = solves.pop(rng.randrange(len(solves)))
+            removed.append(solve)
+            columns.remove(solve[1], solve[0])
+        solves.sort()
+
+        ids, times, durations = columns.live(0, columns.length)
+        assert len(columns) == len(solves)
+        assert [(t, i, d) for t, i, d in zip(times.tolist(), ids.tolist(), durations.tolist())] == solves
+        for count in [1, 5, 50]:
+            assert columns.view(count, recent=True)[0].tolist() == [id for _, id, _ in solves[-count:]]
+            assert columns.view(count)[0].tolist() == [id for _, id, _ in solves[:count]]
+        assert columns.dead <= Columns.COMPACT
+
+    assert columns.view()[0].tolist() == [id for _, id, _ in solves]
+    assert columns.dead == 0 and columns.alive is None
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import numpy as np
+
+from ct import snapshot
+
+
+def solves(lo, hi):
+    ids = np.arange(lo, hi)
+    times = np.datetime64(datetime(2020, 1, 1), 'us') + ids * np.timedelta64(1500001, 'us')
+    durations = np.where(ids % 7 == 0, np.nan, ids * 10.0)
+    return ids, times, durations
+
+
+def test_append(tmp_path):
+    # Appended a few at a time into the room left, then once more than fit
+    path = str(tmp_path / 'appended.snapshot')
+    snapshot.save(path, *solves(1, 100))
+    capacity = snapshot.header(path)[2]
+    for lo in range(100, capacity, 37):
+        assert snapshot.append(path, *solves(lo, min(lo + 37, capacity + 1)))
+    count, last_id, _ = snapshot.header(path)
+    assert (count, last_id) == (capacity, capacity)
+    assert not snapshot.append(path, *solves(capacity + 1, capacity + 2))
+
+    whole = str(tmp_path / 'whole.snapshot')
+    snapshot.save(whole, *solves(1, capacity + 1))
+    appended, saved = snapshot.load(path), snapshot.load(whole)
+    assert appended[0] == saved[0]
+    for a, b in zip(appended[1:], saved[1:]):
+        np.testing.assert_array_equal(a, b)
+        assert a.dtype == b.dtype
+
+
+def test_invalid(tmp_path):
+    path = str(tmp_path / 'x.snapshot')
+    assert snapshot.load(path) is None
+    assert not snapshot.append(path, *solves(1, 2))
+    snapshot.save(path, *solves(1, 10))
+    with open(path, 'r+b') as f:
+        f.write(b'ctsnap00')
+    assert snapshot.load(path) is None
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+import random
+
+import numpy as np
+
+from ct import stats
+from ct.cache import Columns
+
+
+# Whole milliseconds, so that sums are exact however the windows are taken
+COMPUTER = stats.collection(('single', 'mo3', 'ao5', 'ao12'))
+START = datetime(2020, 1, 1)
+
+
+def duration(rng):
+    return np.nan if rng.random() < 0.1 else float(rng.randint(10, 20))
+
+
+def recompute(ids, whens, values):
+    bests, current = {}, []
+    for name, column in COMPUTER.rolling(np.array(values, dtype=float)).items():
+        bests[name] = stats.best(column, whens, ids)
+        current.append(stats.Record(name, whens[-1] if whens else None, column[-1] if len(column) else np.nan))
+    return bests, current
+
+
+def same(bests, expected):
+    assert list(bests) == list(expected)
+    assert [b[1:] for b in bests.values()] == [b[1:] for b in expected.values()]
+    np.testing.assert_array_equal([b[0] for b in bests.values()], [b[0] for b in expected.values()])
+
+
+def test_averages():
+    # Against the window sorted solve by solve, as in SQL
+    rng = random.Random(0)
+    values = np.array([duration(rng) for _ in range(500)])
+    for total in [3, 5, 12, 20, 50, 100]:
+        average = stats.parse(f'ao{total}')
+        window = stats.SortedWindow(total)
+        expected = []
+        for value in values:
+            window.push(value)
+            expected.append(window.trimmed_mean(average.drop, total - average.drop))
+        np.testing.assert_array_equal(average.rolling(values), expected)
+
+
+def test_state():
+    rng = random.Random(0)
+    ids, whens, values = [], [], []
+    state = stats.StatsState(COMPUTER, np.array(values), whens, ids)
+    edits = 0
+    for id in range(1, 500):
+        op = rng.random()
+        if op < 0.6 or len(ids) < 2:
+            ids.append(id)
+            whens.append(START + timedelta(seconds=id))
+            values.append(duration(rng))
+            state.push(ids[-1], whens[-1], values[-1])
+        else:
+            i = rng.randrange(max(0, len(ids) - 2 * COMPUTER.minimum), len(ids))
+            if op < 0.8:
+                values[i] = duration(rng)
+                done = state.update(ids[i], values[i])
+            else:
+                done = state.remove(ids[i])
+                del ids[i], whens[i], values[i]
+            # As Discipline does, when the change reaches past the tail
+            if not done:
+                state = stats.StatsState(COMPUTER, np.array(values), whens, ids)
+            edits += done
+        bests, current = recompute(ids, whens, values)
+        same(state.bests, bests)
+        assert [(r.name, r.when) for r in state.current] == [(r.name, r.when) for r in current]
+        np.testing.assert_array_equal([r.duration for r in state.current], [r.duration for r in current])
+    assert edits > 20
+
+
+def test_blocks(monkeypatch):
+    monkeypatch.setattr(stats.Blocks, 'SIZE', 16)
+    monkeypatch.setattr(Columns, 'COMPACT', 8)
+    rng = random.Random(1)
+
+    # Several solves share each time, so that blocks cannot split them
+    count = 300
+    times = np.array([START + timedelta(seconds=i // 3) for i in range(count)], dtype='datetime64[us]')
+    durations = np.array([duration(rng) for _ in range(count)])
+    columns = Columns(np.arange(1, count + 1), times, durations)
+    blocks = stats.Blocks(COMPUTER, columns)
+
+    for id in range(count + 1, count + 400):
+        ids, times, _ = columns.live(0, columns.length)
+        op = rng.random()
+        if op < 0.5:
+            # At the end, or among the solves of an earlier time
+            if op < 0.3:
+                when = times[-1].item() + timedelta(seconds=rng.randint(0, 1))
+            else:
+                when = times[rng.randrange(len(times))].item() + timedelta(microseconds=rng.randint(0, 1))
+            columns.insert(id, when, duration(rng))
+            _, current = recompute(*(c.tolist() for c in columns.live(0, columns.length)))
+            blocks.push(columns, id, when, [record.duration for record in current])
+        else:
+            i = rng.randrange(len(ids))
+            if op < 0.75:
+                columns.update(ids[i], times[i], duration(rng))
+            else:
+                columns.remove(ids[i], times[i])
+            blocks.refresh(columns, times[i].item())
+        if rng.random() < 0.05:
+            columns.compact()
+
+        # Each block holds the bests of the windows ending on its solves
+        ids, times, values = columns.live(0, columns.length)
+        rolling = COMPUTER.rolling(values)
+        edges = [0, *np.searchsorted(times, np.array(blocks.starts[1:], dtype=times.dtype)), len(ids)]
+        for k, (lo, hi) in enumerate(zip(edges, edges[1:])):
+            assert blocks.sizes[k] == hi - lo
+            same(dict(zip(rolling, blocks.minima[k])), {
+                name: stats.earliest(column[lo:hi], times[lo:hi], ids[lo:hi])
+                for name, column in rolling.items()
+            })
+        bests = {name: stats.earliest(column, times, ids) for name, column in rolling.items()}
+        same(blocks.bests(), bests)
+        same(stats.Blocks(COMPUTER, columns).bests(), bests)
+    assert len(blocks.starts) > 1
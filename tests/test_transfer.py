@@ -0,0 +1,30 @@
+from io import StringIO
+import json
+
+from ct.transfer import JSONReader
+
+
+# Like a csTimer export, with numbers, escapes and nesting to cut anywhere
+DOCUMENT = {
+    'session1': [[[0, 10234], "R U R' U'", '', 1577836800], [[-1, 9876], 'F2 \\"B\\" é', 'a, b]', 1577836812]],
+    'session2': [],
+    'session3': [[[2000, 15000], 'L', '', 1577836900]],
+    'properties': {'sessionData': '{"1": {"name": "3x3"}}', 'n': 123456789, 'f': -1.5e-07},
+    'last': 1234567890123,
+}
+
+
+def items(obj):
+    for key, value in obj.items():
+        if isinstance(value, list):
+            yield from ((key, item) for item in value)
+            yield key, None
+        else:
+            yield key, value
+
+
+def test_chunks():
+    expected = list(items(DOCUMENT))
+    for text in [json.dumps(DOCUMENT), json.dumps(DOCUMENT, indent=2)]:
+        for size in [*range(1, 40), 1 << 16]:
+            assert list(JSONReader(StringIO(text), size).items()) == expected